@@ -1,11 +1,19 @@
 import datetime
+import hashlib
+import random
 import sys
+import threading
+import time
 from typing import NewType, Iterable, Any, Optional
+from urllib.parse import urlsplit
 
 import requests
 import logging
 from requests import Response
 
+import metrics
+from http_cache import HttpCache
+
 GitHubUrl = NewType('GitHubUrl', str)
 PrUrl = NewType('PrUrl', GitHubUrl)
 IssueUrl = NewType('IssueUrl', GitHubUrl)
@@ -16,22 +24,215 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 debug = logger.debug
 
+class RateLimitExceeded(Exception):
+    """The rate limit is exhausted, and won't reset soon enough to wait for it"""
+
+class ApiBudgetExceeded(Exception):
+    """This run has made as many API requests as it is allowed to"""
+
+class RequestScheduler:
+    """
+    Decides when requests can be made, and if failed requests should be retried
+
+    The remaining rate limit is tracked from response headers. As it runs low, requests are spread out
+    until the limit resets, so throughput degrades smoothly instead of failing. Once it is used up, requests
+    wait for the reset, or fail straight away if the reset is further away than max_wait.
+
+    Requests are retried after a jittered exponential backoff:
+    - Any request that was rate limited, after waiting for Retry-After or the rate limit reset
+    - Idempotent requests that failed with a server error or connection error
+    """
+
+    idempotent_methods = ['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE']
+
+    # Start spacing out requests when fewer than this many remain
+    low_remaining = 50
+
+    # The longest a request is delayed to spread out the remaining rate limit, in seconds
+    max_pacing_delay = 5
+
+    def __init__(self, *, budget: Optional[int] = None, max_retries: int = 5, max_wait: float = 15 * 60):
+        """
+        :param budget: The maximum number of requests this run can make, including retries
+        :param max_retries: The maximum number of times a request is retried
+        :param max_wait: The longest time to wait for a request to be allowed, in seconds
+        """
+
+        self._budget = budget
+        self._max_retries = max_retries
+        self._max_wait = max_wait
+
+        self._lock = threading.Lock()
+        self._remaining: Optional[int] = None
+        self._reset: Optional[float] = None
+        self._blocked_until = 0.0
+
+        self.requests = 0
+        self.retries = 0
+
+    def wait_for_turn(self) -> None:
+        """Wait until a request can be made"""
+
+        with self._lock:
+            if self._budget is not None and self.requests >= self._budget:
+                raise ApiBudgetExceeded(f'This run has already made {self.requests} GitHub API requests')
+
+            now = time.time()
+            delay = 0.0
+
+            if self._blocked_until > now:
+                delay = self._blocked_until - now
+            elif self._remaining is not None and self._reset is not None and self._remaining < self.low_remaining and self._reset > now:
+                if self._remaining > 0:
+                    delay = min((self._reset - now) / self._remaining, self.max_pacing_delay)
+                elif self._reset - now <= self._max_wait:
+                    delay = self._reset - now + 1
+                else:
+                    limit_reset = datetime.datetime.fromtimestamp(self._reset, datetime.timezone.utc)
+                    raise RateLimitExceeded(f'The GitHub rate limit is used up. Try again when it resets at {limit_reset:%Y-%m-%d %H:%M:%S} UTC.')
+
+            self.requests += 1
+
+        if delay > 0:
+            debug(f'Waiting {delay:.1f}s before making a request')
+            time.sleep(min(delay, self._max_wait))
+
+    def update(self, response: Response) -> None:
+        """Track the rate limit from a response"""
+
+        with self._lock:
+            try:
+                self._remaining = int(response.headers['X-RateLimit-Remaining'])
+                self._reset = float(response.headers['X-RateLimit-Reset'])
+            except (KeyError, ValueError):
+                pass
+
+    def _backoff(self, attempt: int) -> float:
+        return min(2 ** attempt, 60) * random.uniform(0.5, 1.5)
+
+    def retry_delay(self, method: str, attempt: int, response: Optional[Response]) -> Optional[float]:
+        """
+        How long to wait before retrying a request
+
+        :param method: The request method
+        :param attempt: How many times the request has been retried already
+        :param response: The response to the request, or None if there was a connection error
+        :returns: The number of seconds to wait, or None if the request shouldn't be retried
+        """
+
+        if attempt >= self._max_retries:
+            return None
+
+        if response is None or response.status_code >= 500:
+            return self._backoff(attempt) if method in self.idempotent_methods else None
+
+        if response.status_code not in [403, 429]:
+            return None
+
+        if 'Retry-After' in response.headers:
+            # Secondary rate limit
+            delay = float(response.headers['Retry-After'])
+        elif response.headers.get('X-RateLimit-Remaining') == '0' and response.headers.get('X-RateLimit-Limit') != '0':
+            # Primary rate limit
+            delay = float(response.headers['X-RateLimit-Reset']) - time.time() + 1
+        elif b'secondary rate limit' in response.content:
+            delay = max(60.0, self._backoff(attempt))
+        else:
+            return None
+
+        if delay > self._max_wait:
+            return None
+
+        delay = max(delay, 0) + random.uniform(0, 1)
+
+        with self._lock:
+            # Every request has to wait for the rate limit
+            self._blocked_until = max(self._blocked_until, time.time() + delay)
+
+        return delay
+
 class GithubApi:
-    def __init__(self, host: str, token: Optional[str]):
+    def __init__(
+        self,
+        host: str,
+        token: Optional[str],
+        cache: Optional[HttpCache] = None,
+        scheduler: Optional[RequestScheduler] = None,
+        pool_size: int = 10
+    ):
         self._host = host
         self._token = token
+        self._cache = cache
+        self._scheduler = scheduler if scheduler is not None else RequestScheduler()
 
         self._session = requests.Session()
 
+        # Keep enough connections alive for concurrent requests to the same host
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
         if token is not None:
             self._session.headers['authorization'] = f'token {token}'
 
         self._session.headers['user-agent'] = 'terraform-github-actions'
         self._session.headers['accept'] = 'application/vnd.github.v3+json'
 
+    @property
+    def host(self) -> str:
+        """The base url of the api"""
+        return self._host
+
+    @property
+    def token_digest(self) -> str:
+        """Identifies the token without revealing it"""
+        return hashlib.sha256((self._token or '').encode()).hexdigest()
+
+    def _cache_key(self, url: str, params: Any) -> str:
+        """Identifies a cacheable request, including the token it is made with"""
+
+        prepared_url = requests.Request('GET', url, params=params).prepare().url
+        return f'{self.token_digest} {self._session.headers["accept"]} {prepared_url}'
+
     def api_request(self, method: str, *args, **kwargs) -> requests.Response:
-        response = self._session.request(method, *args, **kwargs)
-        debug(f'{response.request.method} {response.request.url} -> {response.status_code}')
+        with metrics.span('github.request', f'{method} {urlsplit(args[0]).path}' if args else method):
+            return self._api_request(method, *args, **kwargs)
+
+    def _api_request(self, method: str, *args, **kwargs) -> requests.Response:
+        cache_key = None
+
+        if self._cache is not None and method == 'GET' and args:
+            cache_key = self._cache_key(args[0], kwargs.get('params'))
+            kwargs['headers'] = {**self._cache.conditional_headers(cache_key), **kwargs.get('headers', {})}
+
+        attempt = 0
+
+        while True:
+            self._scheduler.wait_for_turn()
+            metrics.increment('github.requests')
+
+            try:
+                response = self._session.request(method, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if (delay := self._scheduler.retry_delay(method, attempt, None)) is None:
+                    raise
+                debug(f'{method} request failed with {e!r}, retrying in {delay:.1f}s')
+            else:
+                debug(f'{response.request.method} {response.request.url} -> {response.status_code}')
+                metrics.increment('github.bytes', len(response.content))
+                self._scheduler.update(response)
+
+                if (delay := self._scheduler.retry_delay(method, attempt, response)) is None:
+                    break
+                debug(f'Retrying in {delay:.1f}s')
+
+            attempt += 1
+            self._scheduler.retries += 1
+            metrics.increment('github.retries')
+            time.sleep(delay)
+
+        if cache_key is not None:
+            response = self._cache.update(cache_key, response)
 
         if 400 <= response.status_code < 500:
             try:
@@ -39,15 +240,15 @@ class GithubApi:
 
                 if response.headers['X-RateLimit-Remaining'] == '0' and response.headers['X-RateLimit-Limit'] != '0':
                     limit_reset = datetime.datetime.fromtimestamp(int(response.headers['X-RateLimit-Reset']))
-                    sys.stdout.write(message)
-                    sys.stdout.write(f' Try again when the rate limit resets at {limit_reset} UTC.\n')
-                    sys.exit(1)
+                    raise RateLimitExceeded(f'{message} Try again when the rate limit resets at {limit_reset} UTC.')
 
                 if message not in ['Resource not accessible by integration', 'Personal access tokens with fine grained access do not support the GraphQL API']:
                     sys.stdout.write(message)
                     sys.stdout.write('\n')
                     debug(response.content.decode())
 
+            except RateLimitExceeded:
+                raise
             except Exception:
                 sys.stdout.write(response.content.decode())
                 sys.stdout.write('\n')
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+from typing import Any, Iterable
+from urllib.parse import urlsplit, parse_qs, urlencode, urlunsplit
+
+from requests import Response
+
+from api import GithubApi, GitHubUrl
+
+logger = logging.getLogger(__name__)
+debug = logger.debug
+
+class AsyncGithubApi:
+    """
+    Makes GithubApi requests from asyncio
+
+    Requests are run on worker threads, so they still go through the scheduler and cache of the GithubApi.
+    At most `concurrency` requests are in flight at once.
+    """
+
+    def __init__(self, github: GithubApi, concurrency: int):
+        self._github = github
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def get(self, url: GitHubUrl, **kwargs: Any) -> Response:
+        async with self._semaphore:
+            return await asyncio.to_thread(self._github.get, url, **kwargs)
+
+    async def get_pages(self, urls: list[GitHubUrl]) -> list[Response]:
+        """Get each of the pages concurrently, returning the responses in the same order"""
+
+        async def get_page(url: GitHubUrl) -> Response:
+            response = await self.get(url)
+            response.raise_for_status()
+            return response
+
+        return await asyncio.gather(*(get_page(url) for url in urls))
+
+def page_urls(last_url: str) -> list[GitHubUrl]:
+    """
+    Get the url of every page from the second up to the `last` link
+
+    Returns an empty list if the page number can't be found in the link.
+    """
+
+    scheme, netloc, path, query, fragment = urlsplit(last_url)
+    params = parse_qs(query)
+
+    try:
+        last_page = int(params['page'][0])
+    except (KeyError, ValueError):
+        return []
+
+    urls = []
+    for page in range(2, last_page + 1):
+        params['page'] = [str(page)]
+        urls.append(GitHubUrl(urlunsplit((scheme, netloc, path, urlencode(params, doseq=True), fragment))))
+
+    return urls
+
+class ConcurrentGithubApi(GithubApi):
+    """
+    A GithubApi that fetches the pages of a paged_get concurrently
+
+    The first page is fetched normally. If it has a `last` link, the remaining pages are fetched
+    `concurrency` at a time using an AsyncGithubApi, so callers can still stop early without fetching every page.
+    Items can be added while the pages are fetched, so any pages after the `last` link are then followed one at a time.
+    Everything else behaves the same as GithubApi.
+    """
+
+    def __init__(self, *args: Any, concurrency: int, **kwargs: Any):
+        super().__init__(*args, pool_size=concurrency, **kwargs)
+        self._concurrency = concurrency
+
+    def paged_get(self, url: GitHubUrl, *args, **kwargs) -> Iterable[dict[str, Any]]:
+        response = self.api_request('GET', url, *args, **kwargs)
+        response.raise_for_status()
+
+        yield from response.json()
+
+        urls = page_urls(response.links['last']['url']) if 'last' in response.links else []
+
+        if not urls:
+            # Either a single page, or a paged resource that doesn't say how many pages there are
+            if 'next' in response.links:
+                kwargs.pop('params', None)
+                yield from super().paged_get(response.links['next']['url'], *args, **kwargs)
+            return
+
+        debug(f'Fetching {len(urls)} more pages, {self._concurrency} at a time')
+
+        for start in range(0, len(urls), self._concurrency):
+            responses = asyncio.run(self._get_pages(urls[start:start + self._concurrency]))
+            for response in responses:
+                yield from response.json()
+
+        if 'next' in response.links:
+            kwargs.pop('params', None)
+            yield from super().paged_get(response.links['next']['url'], *args, **kwargs)
+
+    async def _get_pages(self, urls: list[GitHubUrl]) -> list[Response]:
+        return await AsyncGithubApi(self, self._concurrency).get_pages(urls)
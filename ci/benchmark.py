@@ -0,0 +1,240 @@
+"""
+Benchmark the CodeBuild entry points against local stand-ins for GitHub and AWS
+
+    python3 ci/benchmark.py --stacks 1 50 500
+
+For each number of stacks, a stacks.yaml defining that many stacks is generated in a temporary directory.
+pr.py and then main.py are each run in a fresh interpreter against the same GitHubStub and AwsStub,
+as if the PR was merged after being planned. The wall time, API requests made and peak memory of each run are reported.
+
+With --runs, each entry point is run again against the same stubs and cache directory,
+to show how a run with warm caches behaves.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, NamedTuple, Optional
+
+from stubs import GitHubStub, AwsStub
+
+repo = 'hmrc/aws-users'
+merge_commit = '0123456789abcdef0123456789abcdef01234567'
+
+class Result(NamedTuple):
+    entry_point: str
+    stacks: int
+    run: int
+    seconds: float
+    github_calls: dict[str, int]
+    aws_calls: dict[str, int]
+    peak_memory: int
+    error: Optional[str]
+
+def template(number: int, resources: int) -> str:
+    """A template with `resources` IAM roles"""
+
+    roles = ''.join(f'''
+  Role{resource}:
+    Type: AWS::IAM::Role
+    Properties:
+      RoleName: stack-{number}-role-{resource}
+      AssumeRolePolicyDocument:
+        Version: "2012-10-17"
+        Statement:
+          - Effect: Allow
+            Principal:
+              AWS: !Sub "arn:aws:iam::${{AWS::AccountId}}:root"
+            Action: sts:AssumeRole
+''' for resource in range(resources))
+
+    return f'AWSTemplateFormatVersion: "2010-09-09"\nDescription: Benchmark stack {number}\nResources:{roles}'
+
+def generate_stacks(directory: Path, stacks: int, accounts: int, resources: int) -> list[tuple[str, str]]:
+    """
+    Write a stacks.yaml and templates for `stacks` stacks, spread over `accounts` accounts
+
+    :returns: The account id and stack name of each stack
+    """
+
+    templates = directory / 'output' / 'stack-definitions'
+    templates.mkdir(parents=True)
+
+    defined = []
+    config = {}
+
+    for number in range(stacks):
+        account = number % accounts
+        account_id = str(100000000000 + account)
+        stack_name = f'Stack{number}'
+
+        template_path = templates / f'stack-{number}.yaml'
+        template_path.write_text(template(number, resources))
+
+        config.setdefault(f'account-{account}', {'account-id': account_id, 'stacks': []})['stacks'].append({
+            'name': stack_name,
+            'template': str(template_path.relative_to(directory)),
+        })
+        defined.append((account_id, stack_name))
+
+    # json is valid yaml
+    (directory / 'stacks.yaml').write_text(json.dumps(config, indent=2))
+
+    return defined
+
+def run(entry_point: str, directory: Path, cache_dir: Path, github: GitHubStub, aws: AwsStub, template_bucket: Optional[str] = None) -> dict[str, Any]:
+    """Run an entry point in a fresh interpreter, returning what it measured"""
+
+    environment = {
+        **os.environ,
+        'GITHUB_API_URL': github.url,
+        'GITHUB_TOKEN': 'benchmark',
+        'AWS_ENDPOINT_URL': aws.url,
+        'AWS_ACCESS_KEY_ID': 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'AWS_DEFAULT_REGION': 'eu-west-1',
+        'AWS_USERS_CACHE_DIR': str(cache_dir),
+        'CODEBUILD_SOURCE_REPO_URL': f'https://github.com/{repo}.git',
+        'CODEBUILD_WEBHOOK_EVENT': 'PULL_REQUEST_UPDATED' if entry_point == 'pr' else 'PUSH',
+        'CODEBUILD_WEBHOOK_TRIGGER': 'pr/1',
+        'CODEBUILD_RESOLVED_SOURCE_VERSION': merge_commit,
+    }
+
+    if template_bucket:
+        environment['TEMPLATE_BUCKET'] = template_bucket
+
+    result_path = directory / 'result.json'
+
+    with open(directory / f'{entry_point}.log', 'a') as log:
+        subprocess.run(
+            [sys.executable, __file__, '--measure', entry_point, str(result_path)],
+            cwd=directory,
+            env=environment,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            check=True,
+        )
+
+    return json.loads(result_path.read_text())
+
+def measure(entry_point: str, result_path: Path) -> None:
+    """Import and run an entry point in this interpreter, writing the measurements to result_path"""
+
+    error = None
+    start = time.perf_counter()
+
+    try:
+        importlib.import_module(entry_point).main()
+    except Exception as e:
+        error = repr(e)
+
+    seconds = time.perf_counter() - start
+
+    result_path.write_text(json.dumps({
+        'seconds': seconds,
+        # ru_maxrss is in kilobytes on linux
+        'peak_memory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'error': error,
+    }))
+
+def benchmark(args: argparse.Namespace) -> list[Result]:
+    results = []
+
+    print(f'{"entry point":<12} {"stacks":>6} {"run":>3} {"seconds":>8} {"github":>7} {"aws":>7} {"peak MiB":>9}')
+
+    for stacks in args.stacks:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            directory = Path(temp_dir)
+            defined = generate_stacks(directory, stacks, min(args.accounts, stacks), args.resources)
+            templates = [str(path.relative_to(directory)) for path in sorted((directory / 'output').rglob('*.yaml'))]
+
+            # main.py runs after pr.py against the same stubs, like a PR being merged after it was planned
+            with GitHubStub(
+                repo=repo,
+                files=templates,
+                comments=args.comments,
+                merge_commit=merge_commit,
+                page_size=args.page_size,
+                rate_limit=args.rate_limit,
+                latency=args.github_latency,
+            ) as github, AwsStub(
+                stacks=defined,
+                changes=args.changes,
+                changeset_delay=args.changeset_delay,
+                request_rate=args.aws_request_rate,
+                latency=args.aws_latency,
+            ) as aws:
+
+                for entry_point in ['pr', 'main']:
+                    cache_dir = directory / f'{entry_point}-cache'
+
+                    for run_number in range(1, args.runs + 1):
+                        github_calls, aws_calls = dict(github.calls), dict(aws.calls)
+                        measured = run(entry_point, directory, cache_dir, github, aws, args.template_bucket)
+
+                        result = Result(
+                            entry_point=entry_point,
+                            stacks=stacks,
+                            run=run_number,
+                            seconds=measured['seconds'],
+                            github_calls={call: count - github_calls.get(call, 0) for call, count in github.calls.items() if count != github_calls.get(call, 0)},
+                            aws_calls={call: count - aws_calls.get(call, 0) for call, count in aws.calls.items() if count != aws_calls.get(call, 0)},
+                            peak_memory=measured['peak_memory'],
+                            error=measured['error'],
+                        )
+                        results.append(result)
+
+                        print(
+                            f'{entry_point:<12} {stacks:>6} {run_number:>3} {result.seconds:>8.2f} '
+                            f'{sum(result.github_calls.values()):>7} {sum(result.aws_calls.values()):>7} '
+                            f'{result.peak_memory / 1024 / 1024:>9.1f}'
+                            + (f'  {result.error}' if result.error else '')
+                        )
+
+                        if args.verbose:
+                            for call, count in sorted({**result.github_calls, **result.aws_calls}.items()):
+                                print(f'    {call}: {count}')
+
+    return results
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark pr.py and main.py against local GitHub and AWS stand-ins')
+    parser.add_argument('--stacks', type=int, nargs='+', default=[1, 50, 500], help='The numbers of stacks to benchmark with')
+    parser.add_argument('--accounts', type=int, default=10, help='The number of accounts the stacks are spread over')
+    parser.add_argument('--resources', type=int, default=10, help='The number of resources in each template')
+    parser.add_argument('--changes', type=int, default=10, help='The number of changes in each changeset')
+    parser.add_argument('--changeset-delay', type=float, default=0, help='How long a changeset takes to create, in seconds')
+    parser.add_argument('--comments', type=int, default=100, help='The number of comments already on the PR')
+    parser.add_argument('--page-size', type=int, default=100, help='The largest page GitHub returns')
+    parser.add_argument('--rate-limit', type=int, default=5000, help='GitHub requests allowed per hour')
+    parser.add_argument('--aws-request-rate', type=float, default=0, help='AWS requests allowed per second before throttling, 0 for no limit')
+    parser.add_argument('--github-latency', type=float, default=0.05, help='Added to every GitHub response, in seconds')
+    parser.add_argument('--aws-latency', type=float, default=0.02, help='Added to every AWS response, in seconds')
+    parser.add_argument('--template-bucket', help='Stage templates in this bucket of the AWS stand-in')
+    parser.add_argument('--runs', type=int, default=1, help='How many times to run each entry point with the same caches')
+    parser.add_argument('--json', type=Path, help='Also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='Show the requests made to each endpoint')
+    parser.add_argument('--measure', nargs=2, metavar=('ENTRY_POINT', 'RESULT_PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        entry_point, result_path = args.measure
+        measure(entry_point, Path(result_path))
+        return 0
+
+    results = benchmark(args)
+
+    if args.json:
+        args.json.write_text(json.dumps([result._asdict() for result in results], indent=2))
+
+    return 1 if any(result.error for result in results) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+import json
+import os
+import logging
+import tempfile
+from pathlib import Path
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+debug = logger.debug
+
+def cache_dir() -> Path:
+    """
+    The directory for caches that should outlive a single run
+
+    This is shared by the pr.py and main.py runs in the same build container.
+    """
+
+    return Path(os.environ.get('AWS_USERS_CACHE_DIR', Path.home() / '.cache' / 'aws-users'))
+
+def read_json(path: Path) -> Optional[Any]:
+    """Read a json cache file, returning None if it doesn't exist or can't be read"""
+
+    try:
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        debug(f'Ignoring unreadable cache file {path}: {e}')
+        return None
+
+def write_json(path: Path, data: Any) -> None:
+    """
+    Atomically write a json cache file that is only readable by the current user
+
+    Failing to write a cache file is not an error, including when the data can't be represented as json.
+    """
+
+    tmp_path = None
+
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+
+        os.replace(tmp_path, path)
+        tmp_path = None
+    except (OSError, TypeError, ValueError) as e:
+        debug(f'Unable to write cache file {path}: {e}')
+    finally:
+        if tmp_path is not None:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
@@ -0,0 +1,549 @@
+import functools
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable, Tuple, TypedDict, Any, Optional, NamedTuple
+
+import logging
+
+import metrics
+from config import Stack, load_stacks, parameter_value
+from credentials import CredentialCache, credential_cache
+from templates import minify, submitted_template, template_parameter
+
+logger = logging.getLogger()
+debug = logger.debug
+
+# How many changesets can be created at once, in total and per account
+changeset_concurrency = int(os.environ.get('CHANGESET_CONCURRENCY', 8))
+account_concurrency = int(os.environ.get('CHANGESET_ACCOUNT_CONCURRENCY', 2))
+
+# Don't create changesets for stacks that are already deployed with the same template and parameters
+skip_unchanged_stacks = os.environ.get('SKIP_UNCHANGED_STACKS', 'true').lower() != 'false'
+
+# How long to wait for all changesets to settle, in seconds
+changeset_wait_timeout = int(os.environ.get('CHANGESET_WAIT_TIMEOUT', 60 * 60))
+
+class Change(NamedTuple):
+    """The parts of a changeset resource change that we use"""
+    action: str
+    resource_type: str
+    logical_id: str
+    replacement: Optional[str]
+
+def compact_change(change: dict[str, Any]) -> Optional[Change]:
+    if (resource_change := change.get('ResourceChange')) is None:
+        return None
+
+    return Change(
+        action=resource_change.get('Action'),
+        resource_type=resource_change['ResourceType'],
+        logical_id=resource_change['LogicalResourceId'],
+        replacement=resource_change.get('Replacement'),
+    )
+
+class Changeset(TypedDict):
+    ChangeSetName: str
+    ChangeSetId: str
+    StackId: str
+    StackName: str
+    Status: str
+    StatusReason: str
+    ExecutionStatus: str
+    Changes: list[Change]
+
+def changeset_name_prefix(trigger: str) -> str:
+    """
+    The start of the name of every changeset created by a build with this webhook trigger
+
+    >>> changeset_name_prefix('pr/123')
+    'pr-123-'
+    """
+
+    # Changeset names may only contain letters, numbers and hyphens
+    return re.sub('[^a-zA-Z0-9-]', '-', trigger) + '-'
+
+def changeset_name() -> str:
+    return f"{changeset_name_prefix(os.environ.get('CODEBUILD_WEBHOOK_TRIGGER', 'unknown-pr'))}{os.environ.get('CODEBUILD_RESOLVED_SOURCE_VERSION', 'unknown-commit')}-{os.environ.get('CODEBUILD_BUILD_NUMBER', int(time.time()))}"
+
+class Cloudformation:
+    def __init__(self, credentials: CredentialCache):
+        self._credentials = credentials
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._session = None
+
+    def cloudformation_client(self, account_id: str, role_name: str):
+        """
+        Get a cloudformation client that uses the role in the account
+
+        The client is reused until the credentials for the role are refreshed.
+        This can be called from any thread.
+        """
+
+        role_arn = f'arn:aws:iam::{account_id}:role/{role_name}'
+        credentials = self._credentials.credentials(role_arn)
+
+        # boto3 clients are thread safe once created, but creating them is not
+        with self._lock:
+            client, access_key_id = self._clients.get(role_arn, (None, None))
+
+            if client is None or access_key_id != credentials['AccessKeyId']:
+                if self._session is None:
+                    import boto3
+                    self._session = boto3.session.Session()
+
+                client = self._session.client(
+                    'cloudformation',
+                    aws_access_key_id=credentials['AccessKeyId'],
+                    aws_secret_access_key=credentials['SecretAccessKey'],
+                    aws_session_token=credentials['SessionToken'],
+                    region_name='eu-west-1'
+                )
+                metrics.instrument_boto_client(client, account_id)
+
+                self._clients[role_arn] = client, credentials['AccessKeyId']
+
+            return client
+
+    def changeset_creator(self, account_id: str):
+        return self.cloudformation_client(account_id, 'RoleChangeSetCreator')
+
+    def changeset_executor(self, account_id: str):
+        return self.cloudformation_client(account_id, 'RoleIAMAdministrator')
+
+@functools.cache
+def cloudformation() -> Cloudformation:
+    """The Cloudformation clients for this process, created on first use"""
+    return Cloudformation(credential_cache())
+
+def defined_stacks() -> Iterable[Stack]:
+    return load_stacks()
+
+
+def normalise_template(template_body: str) -> str:
+    """
+    Put a template in the form that CloudFormation returns it
+
+    boto3 decodes JSON templates, so they can only be compared after being reencoded.
+    YAML templates are returned exactly as they were submitted.
+    """
+
+    try:
+        return json.dumps(json.loads(template_body), separators=(',', ':'))
+    except ValueError:
+        return template_body
+
+
+def template_digest(template_body: str, parameters: dict[str, str]) -> str:
+    """A digest that identifies a template together with its parameters"""
+
+    digest = hashlib.sha256(normalise_template(template_body).encode())
+    digest.update(json.dumps(parameters, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def stack_digest(stack: Stack) -> str:
+    """A short digest of the template and parameters a stack has now"""
+    return template_digest(stack.template(), stack.parameters)[:16]
+
+
+def returned_template(response: dict[str, Any]) -> str:
+    """The template body from a get_template response, which boto3 decodes if it is JSON"""
+
+    template_body = response['TemplateBody']
+    if not isinstance(template_body, str):
+        template_body = json.dumps(template_body)
+    return template_body
+
+
+def explicit_parameters(stack: Stack, template_body: str, parameters: list[dict[str, Any]]) -> dict[str, str]:
+    """
+    The parameters CloudFormation returns for a stack or changeset, without those left to their default
+
+    CloudFormation also lists the parameters that were left to their default, so those are left out
+    to match the parameters the stack is planned with.
+    """
+
+    try:
+        defaults = {key: parameter_value(value['Default']) for key, value in json.loads(minify(template_body)).get('Parameters', {}).items() if 'Default' in value}
+    except (ValueError, AttributeError):
+        defaults = {}
+
+    return {
+        parameter['ParameterKey']: parameter.get('ParameterValue')
+        for parameter in parameters
+        if parameter['ParameterKey'] in stack.parameters or parameter.get('ParameterValue') != defaults.get(parameter['ParameterKey'])
+    }
+
+
+def deployed_digest(stack: Stack) -> Optional[str]:
+    """
+    The template digest of the deployed stack
+
+    Returns None if the stack doesn't exist or isn't in a stable state.
+    """
+
+    from botocore.exceptions import ClientError
+
+    client = cloudformation().changeset_creator(stack.account_id)
+
+    try:
+        [deployed] = client.describe_stacks(StackName=stack.stack_name)['Stacks']
+    except ClientError as e:
+        debug(f'Unable to describe {stack.key}: {e}')
+        return None
+
+    if deployed['StackStatus'] not in ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE', 'IMPORT_COMPLETE', 'IMPORT_ROLLBACK_COMPLETE']:
+        return None
+
+    template_body = returned_template(client.get_template(StackName=stack.stack_name, TemplateStage='Original'))
+
+    return template_digest(template_body, explicit_parameters(stack, template_body, deployed.get('Parameters', [])))
+
+
+def unchanged_changeset(stack: Stack) -> Changeset:
+    """A placeholder for a stack that is already deployed with the same template and parameters"""
+
+    return Changeset(
+        ChangeSetName='',
+        ChangeSetId='',
+        StackId='',
+        StackName=stack.stack_name,
+        Status='UNCHANGED',
+        StatusReason='The deployed template and parameters are unchanged',
+        ExecutionStatus='UNAVAILABLE',
+        Changes=[],
+    )
+
+
+def is_unchanged(changeset: Changeset) -> bool:
+    return changeset['Status'] == 'UNCHANGED'
+
+
+def create_changeset(stack: Stack) -> Changeset:
+    template_body = submitted_template(stack)
+
+    if skip_unchanged_stacks:
+        try:
+            if deployed_digest(stack) == template_digest(template_body, stack.parameters):
+                logger.info(f"{stack.account_name}/{stack.stack_name} is unchanged, not creating a changeset")
+                return unchanged_changeset(stack)
+        except Exception:
+            logger.exception(f"Unable to compare {stack.key} with the deployed stack")
+
+    logger.info(f"Creating changeset for {stack.account_name}/{stack.stack_name}...")
+    response = cloudformation().changeset_creator(stack.account_id).create_change_set(
+        StackName=stack.stack_name,
+        **template_parameter(template_body),
+        Parameters=[{'ParameterKey': key, 'ParameterValue': value} for key, value in stack.parameters.items()],
+        ChangeSetName=changeset_name(),
+        Capabilities=['CAPABILITY_NAMED_IAM'],
+        Description=f"Changeset generated from an aws-users PR",
+    )
+
+    debug(f"Created changeset {response['Id']}")
+
+    # The changeset has only just started being created, wait_for_changesets will get the changes once it is complete
+    return Changeset(
+        ChangeSetName=changeset_name(),
+        ChangeSetId=response['Id'],
+        StackId=response['StackId'],
+        StackName=stack.stack_name,
+        Status='CREATE_PENDING',
+        StatusReason='',
+        ExecutionStatus='UNAVAILABLE',
+        Changes=[],
+    )
+
+
+def describe_changeset(stack: Stack, changeset_id: str) -> Changeset:
+    """
+    Get a complete description of a changeset
+
+    Every page of changes is fetched, and each change is reduced to a compact Change.
+    """
+
+    client = cloudformation().changeset_creator(stack.account_id)
+
+    kwargs = {}
+    changes = []
+
+    while True:
+        response = client.describe_change_set(ChangeSetName=changeset_id, **kwargs)
+        changes.extend(change for change in map(compact_change, response.get('Changes', [])) if change is not None)
+
+        if 'NextToken' not in response:
+            break
+        kwargs['NextToken'] = response['NextToken']
+
+    debug(f"Changeset {changeset_id} for {stack.key} is {response['Status']} with {len(changes)} changes")
+
+    return Changeset(
+        ChangeSetName=response['ChangeSetName'],
+        ChangeSetId=response['ChangeSetId'],
+        StackId=response['StackId'],
+        StackName=response['StackName'],
+        Status=response['Status'],
+        StatusReason=response.get('StatusReason', ''),
+        ExecutionStatus=response.get('ExecutionStatus', 'UNAVAILABLE'),
+        Changes=changes,
+    )
+
+
+def changeset_status(stack: Stack, changeset: Changeset) -> Changeset:
+    """
+    Get the current status of a changeset, without its changes
+
+    Only the first page of the description is fetched, however large the changeset is.
+    """
+
+    response = cloudformation().changeset_creator(stack.account_id).describe_change_set(ChangeSetName=changeset['ChangeSetId'])
+
+    debug(f"Changeset {changeset['ChangeSetId']} for {stack.key} is {response['Status']}/{response.get('ExecutionStatus')}")
+
+    return Changeset(**{
+        **changeset,
+        'Status': response['Status'],
+        'StatusReason': response.get('StatusReason', ''),
+        'ExecutionStatus': response.get('ExecutionStatus', 'UNAVAILABLE'),
+    })
+
+
+def changeset_digest(stack: Stack, changeset_id: str, described: dict[str, Any]) -> str:
+    """The template digest of a changeset, with the parameters it was created with"""
+
+    client = cloudformation().changeset_executor(stack.account_id)
+    template_body = returned_template(client.get_template(StackName=described['StackId'], ChangeSetName=changeset_id, TemplateStage='Original'))
+
+    return template_digest(template_body, explicit_parameters(stack, template_body, described.get('Parameters', [])))
+
+
+def planned_changeset(stack: Stack, changeset_id: str, digest: str, name_prefix: str) -> Optional[Changeset]:
+    """
+    Get a changeset that was created earlier, if it can still be executed
+
+    The changeset id and digest come from a PR comment, which anyone who can comment on the PR can edit,
+    so they are only used to find the changeset. The changeset itself must have been created for this stack
+    by a build of the PR (its name starts with `name_prefix`), from the template and parameters the stack has now,
+    and still be available to execute. A changeset becomes obsolete if the stack is updated some other way.
+
+    :returns: The changeset, or None if it can't be used
+    """
+
+    if stack_digest(stack) != digest:
+        debug(f'Changeset {changeset_id} for {stack.key} was created from a different template')
+        return None
+
+    try:
+        response = cloudformation().changeset_executor(stack.account_id).describe_change_set(ChangeSetName=changeset_id)
+    except Exception as e:
+        debug(f'Unable to describe changeset {changeset_id} for {stack.key}: {e}')
+        return None
+
+    if response['StackName'] != stack.stack_name or not response['ChangeSetName'].startswith(name_prefix):
+        logger.warning(f"Changeset {changeset_id} is {response['ChangeSetName']} for {response['StackName']}, which wasn't planned for {stack.key} on this PR")
+        return None
+
+    if response['Status'] != 'CREATE_COMPLETE' or response.get('ExecutionStatus') != 'AVAILABLE':
+        debug(f"Changeset {changeset_id} for {stack.key} is {response['Status']}/{response.get('ExecutionStatus')}")
+        return None
+
+    try:
+        matches = changeset_digest(stack, changeset_id, response) == template_digest(submitted_template(stack), stack.parameters)
+    except Exception as e:
+        debug(f'Unable to get the template of changeset {changeset_id} for {stack.key}: {e}')
+        return None
+
+    if not matches:
+        logger.warning(f'Changeset {changeset_id} for {stack.key} has a different template or parameters to the stack')
+        return None
+
+    return Changeset(
+        ChangeSetName=response['ChangeSetName'],
+        ChangeSetId=response['ChangeSetId'],
+        StackId=response['StackId'],
+        StackName=response['StackName'],
+        Status=response['Status'],
+        StatusReason=response.get('StatusReason', ''),
+        ExecutionStatus=response['ExecutionStatus'],
+        Changes=[change for change in map(compact_change, response.get('Changes', [])) if change is not None],
+    )
+
+
+def failed_changeset(stack: Stack, reason: str) -> Changeset:
+    """A placeholder for a changeset that could not be created"""
+
+    return Changeset(
+        ChangeSetName=changeset_name(),
+        ChangeSetId='',
+        StackId='',
+        StackName=stack.stack_name,
+        Status='FAILED',
+        StatusReason=reason,
+        ExecutionStatus='UNAVAILABLE',
+        Changes=[],
+    )
+
+
+def create_changeset_safely(stack: Stack) -> Changeset:
+    """
+    Create a changeset for a stack, reporting any error as a failed changeset
+
+    A failure to create one changeset shouldn't prevent the others from being created.
+    """
+
+    try:
+        with metrics.span('changeset.create', stack.key):
+            return create_changeset(stack)
+    except Exception as e:
+        logger.exception(f"Failed to create changeset for {stack.account_name}/{stack.stack_name}")
+        return failed_changeset(stack, str(e))
+
+
+def create_all_changesets(stacks: Optional[list[Stack]] = None, parallel: bool = changeset_concurrency > 1) -> list[Tuple[Stack, Changeset]]:
+    """
+    Create a changeset for every defined stack, or just the given stacks
+
+    When parallel, changesets are created concurrently with at most `changeset_concurrency` in flight,
+    and at most `account_concurrency` in the same account.
+    The result is in the same order as the stacks are defined, whichever mode is used.
+    """
+
+    if stacks is None:
+        stacks = list(defined_stacks())
+
+    if not parallel:
+        return [(stack, create_changeset_safely(stack)) for stack in stacks]
+
+    # Each account has a queue of stacks, worked through by up to `account_concurrency` lanes.
+    # A lane only holds a worker while there are stacks in its queue, so an account with many stacks never
+    # leaves workers waiting for its limit while stacks in other accounts could be created.
+    queues: dict[str, deque[int]] = defaultdict(deque)
+    for index, stack in enumerate(stacks):
+        queues[stack.account_id].append(index)
+
+    changesets: dict[int, Changeset] = {}
+
+    def lane(queue: deque[int]) -> None:
+        while queue:
+            try:
+                index = queue.popleft()
+            except IndexError:
+                return
+            changesets[index] = create_changeset_safely(stacks[index])
+
+    # The first lane of every account is started before the second lane of any
+    lanes = [queue for number in range(max(account_concurrency, 1)) for queue in queues.values() if len(queue) > number]
+
+    with ThreadPoolExecutor(max_workers=changeset_concurrency, thread_name_prefix='changeset') as executor:
+        for future in [executor.submit(lane, queue) for queue in lanes]:
+            future.result()
+
+    return [(stack, changesets[index]) for index, stack in enumerate(stacks)]
+
+
+def is_created(changeset: Changeset) -> bool:
+    """Has CloudFormation finished creating the changeset"""
+    return changeset['Status'].endswith('_COMPLETE') or changeset['Status'].endswith('FAILED')
+
+
+@dataclass
+class _Poll:
+    """Backoff state for a changeset that is being waited on"""
+    index: int
+    stack: Stack
+    changeset: Changeset
+    next_poll: float = 0
+    delay: float = 1
+
+
+@metrics.span('changeset.wait')
+def wait_for_changesets(
+    changesets: list[Tuple[Stack, Changeset]],
+    timeout: float = changeset_wait_timeout,
+) -> list[Tuple[Stack, Changeset]]:
+    """
+    Wait for all changesets to be created, and get their changes
+
+    All pending changesets are polled together in rounds, each with its own exponential backoff,
+    so the total wait is about as long as the slowest changeset.
+
+    :param changesets: The changesets to wait for
+    :param timeout: The number of seconds to wait for all changesets before giving up
+    :returns: The latest description of each changeset, in the same order.
+              Changesets that haven't been created by the timeout are returned as failed.
+    """
+
+    ready_changesets = list(changesets)
+    deadline = time.monotonic() + timeout
+
+    pending = [
+        _Poll(index, stack, changeset)
+        for index, (stack, changeset) in enumerate(changesets)
+        # A changeset with no id was never created
+        if changeset['ChangeSetId']
+    ]
+
+    while pending:
+        now = time.monotonic()
+
+        for poll in [poll for poll in pending if poll.next_poll <= now]:
+            try:
+                changeset = changeset_status(poll.stack, poll.changeset)
+
+                if changeset['Status'] == 'CREATE_COMPLETE':
+                    changeset = describe_changeset(poll.stack, changeset['ChangeSetId'])
+            except Exception as e:
+                logger.exception(f"Failed to describe changeset for {poll.stack.account_name}/{poll.stack.stack_name}")
+                changeset = failed_changeset(poll.stack, str(e))
+
+            if not changeset['ChangeSetId'] or is_created(changeset):
+                ready_changesets[poll.index] = (poll.stack, changeset)
+                pending.remove(poll)
+                continue
+
+            poll.next_poll = time.monotonic() + poll.delay
+            poll.delay = min(poll.delay * 2, 30)
+
+        if not pending:
+            break
+
+        next_poll = min(poll.next_poll for poll in pending)
+        if next_poll > deadline:
+            logger.error(f"Timed out waiting for changesets: {', '.join(f'{poll.stack.account_name}/{poll.stack.stack_name}' for poll in pending)}")
+
+            for poll in pending:
+                ready_changesets[poll.index] = (poll.stack, {
+                    **poll.changeset,
+                    'Status': 'FAILED',
+                    'StatusReason': f'Timed out after {timeout:.0f}s waiting for the changeset',
+                })
+            break
+
+        print(f"Waiting for {len(pending)} changesets: {', '.join(f'{poll.stack.account_name}/{poll.stack.stack_name}' for poll in pending)}...")
+        time.sleep(max(next_poll - time.monotonic(), 0))
+
+    return ready_changesets
+
+
+def has_changes(changeset: Changeset) -> bool:
+    if is_unchanged(changeset):
+        print(f'No changes detected in {changeset["StackName"]}')
+        return False
+
+    if changeset['Status'] == 'FAILED' and changeset['StatusReason'] == "The submitted information didn't contain changes. Submit different information to create a change set.":
+        print(f'No changes detected in {changeset["StackName"]}')
+        return False
+
+    return True
+
+def is_failed(changeset: Changeset) -> bool:
+    return changeset['Status'] == 'FAILED' or changeset.get('ExecutionStatus') == 'EXECUTE_FAILED'
+
@@ -1,10 +1,12 @@
+import hashlib
 import json
 
 import re
 import logging
 from json import JSONDecodeError
-from typing import Optional, Any
+from typing import Callable, Iterator, Optional, Any, cast
 
+import metrics
 from api import IssueUrl, GithubApi, CommentUrl
 
 version = '0.0.1'
@@ -16,13 +18,36 @@ debug = logger.debug
 
 collapse_threshold = 10
 
+# Every comment we make starts with this
+_header_prefix = '<!-- hmrc/aws-users'
+_header_re = re.compile(r'^<!--\shmrc/aws-users\s(?P<args>.*)\s-->')
+
 class GitHubComment:
 
-    def __init__(self, *, issue_url: IssueUrl, comment_url: Optional[CommentUrl], headers: dict[str, str], body: str):
+    def __init__(
+        self,
+        *,
+        issue_url: IssueUrl,
+        comment_url: Optional[CommentUrl],
+        headers: dict[str, str],
+        body: str = '',
+        raw_body: Optional[str] = None,
+        body_start: int = 0
+    ):
+        """
+        :param body: The body of the comment, without the header
+        :param raw_body: The full text of the comment as fetched from GitHub, used instead of body.
+                         The body is only taken from it if it is accessed.
+        :param body_start: Where the body starts in raw_body
+        """
+
         self._issue_url = issue_url
         self._comment_url = comment_url
         self._headers = headers
-        self._body = body.strip()
+
+        self._raw_body = raw_body
+        self._body_start = body_start
+        self._body = body.strip() if raw_body is None else None
 
     def __eq__(self, other):
         if not isinstance(other, GitHubComment):
@@ -32,14 +57,14 @@ class GitHubComment:
             self._issue_url == other._issue_url and
             self._comment_url == other._comment_url and
             self._headers == other._headers and
-            self._body == other._body
+            self.body == other.body
         )
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __repr__(self):
-        return f'GitHubComment(issue_url={self._issue_url!r}, comment_url={self._comment_url!r}, headers={self._headers!r}, body={self._body!r})'
+        return f'GitHubComment(issue_url={self._issue_url!r}, comment_url={self._comment_url!r}, headers={self._headers!r}, body={self.body!r})'
 
     @property
     def comment_url(self) -> Optional[CommentUrl]:
@@ -61,16 +86,19 @@ class GitHubComment:
 
     @property
     def body(self) -> str:
+        if self._body is None:
+            self._body = self._raw_body[self._body_start:].strip()
+            self._raw_body = None
         return self._body
 
 def _format_comment_header(**kwargs) -> str:
     return f'<!-- hmrc/aws-users {json.dumps(kwargs, separators=(",",":"))} -->'
 
 def _parse_comment_header(comment_header: Optional[str]) -> dict[str, str]:
-    if comment_header is None:
+    if comment_header is None or not comment_header.startswith(_header_prefix):
         return {}
 
-    if header := re.match(r'^<!--\shmrc/aws-users\s(?P<args>.*)\s-->', comment_header):
+    if header := _header_re.match(comment_header):
         try:
             return json.loads(header['args'])
         except JSONDecodeError:
@@ -78,27 +106,46 @@ def _parse_comment_header(comment_header: Optional[str]) -> dict[str, str]:
 
     return {}
 
+def _split_header(raw_body: str) -> tuple[Optional[str], int]:
+    """
+    Find the header at the start of a comment
 
-def _from_api_payload(comment: dict[str, Any]) -> Optional[GitHubComment]:
-    match = re.match(r'''
-            (?P<headers><!--.*?-->\n)?
-            (?P<body>.*)
-        ''',
-        comment['body'],
-        re.VERBOSE | re.DOTALL
-    )
+    :returns: The header line if there is one, and where the body starts
+    """
+
+    if not raw_body.startswith('<!--'):
+        return None, 0
+
+    end = raw_body.find('-->\n')
+    if end == -1:
+        return None, 0
 
-    if not match:
-        return None
+    return raw_body[:end + 3], end + 4
+
+def _from_api_payload(comment: dict[str, Any]) -> Optional[GitHubComment]:
+    raw_body = comment['body']
+    header, body_start = _split_header(raw_body)
 
     return GitHubComment(
         issue_url=comment['issue_url'],
         comment_url=comment['url'],
-        headers=_parse_comment_header(match.group('headers')),
-        body=match.group('body').strip()
+        headers=_parse_comment_header(header),
+        raw_body=raw_body,
+        body_start=body_start,
     )
 
 
+def comment_digest(headers: dict[str, str], body: str) -> str:
+    """
+    A digest of the content of a comment
+
+    An unchanged comment is detected by comparing this for the fetched comment and the new content.
+    It is also stored in the 'digest' header.
+    """
+
+    content = json.dumps({k: v for k, v in headers.items() if k != 'digest'}, sort_keys=True) + '\n' + body.strip()
+    return hashlib.sha256(content.encode()).hexdigest()[:16]
+
 def _to_api_payload(comment: GitHubComment) -> str:
     header = _format_comment_header(**comment.headers)
 
@@ -125,7 +172,103 @@ def matching_headers(comment: GitHubComment, headers: dict[str, str]) -> bool:
 
     return True
 
-def find_comment(github: GithubApi, issue_url: IssueUrl, username: str, headers: dict[str, str]) -> GitHubComment:
+_comments_query = """
+query($owner: String!, $repo: String!, $number: Int!, $before: String) {
+  repository(owner: $owner, name: $repo) {
+    issueOrPullRequest(number: $number) {
+      ... on Issue { comments(last: 50, before: $before) { ...comments } }
+      ... on PullRequest { comments(last: 50, before: $before) { ...comments } }
+    }
+  }
+}
+fragment comments on IssueCommentConnection {
+  pageInfo { hasPreviousPage startCursor }
+  nodes { databaseId author { login } body }
+}
+"""
+
+class GraphQLUnavailable(Exception):
+    """The GraphQL API can't be used to find comments"""
+
+def _comments_graphql(github: GithubApi, issue_url: IssueUrl, username: str) -> Iterator[GitHubComment]:
+    """
+    The comments made by a user that have a header, newest first, using the GraphQL API
+
+    Only the header line of each comment is parsed until its body is needed.
+    Raises GraphQLUnavailable if the GraphQL API can't be used.
+    """
+
+    issue = re.match(r'^(?P<api>.*)/repos/(?P<owner>[^/]+)/(?P<repo>[^/]+)/issues/(?P<number>\d+)$', issue_url)
+    if not issue:
+        raise GraphQLUnavailable(f"Can't find the repository for {issue_url}")
+
+    before = None
+
+    while True:
+        response = github.post(issue['api'] + '/graphql', json={
+            'query': _comments_query,
+            'variables': {'owner': issue['owner'], 'repo': issue['repo'], 'number': int(issue['number']), 'before': before}
+        })
+
+        try:
+            response.raise_for_status()
+            comments = response.json()['data']['repository']['issueOrPullRequest']['comments']
+        except Exception as e:
+            raise GraphQLUnavailable(str(e)) from e
+
+        for node in reversed(comments['nodes']):
+            if node['author'] is None or node['author']['login'] != username:
+                continue
+
+            header, body_start = _split_header(node['body'])
+
+            if comment_headers := _parse_comment_header(header):
+                yield GitHubComment(
+                    issue_url=issue_url,
+                    comment_url=cast(CommentUrl, f'{issue["api"]}/repos/{issue["owner"]}/{issue["repo"]}/issues/comments/{node["databaseId"]}'),
+                    headers=comment_headers,
+                    raw_body=node['body'],
+                    body_start=body_start,
+                )
+
+        if not comments['pageInfo']['hasPreviousPage']:
+            return
+
+        before = comments['pageInfo']['startCursor']
+
+def _comments_rest(github: GithubApi, issue_url: IssueUrl, username: str) -> Iterator[GitHubComment]:
+    """The comments made by a user that have a header, by paging through every comment using the REST API"""
+
+    for comment_payload in github.paged_get(issue_url + '/comments', params={'per_page': 100}):
+        if comment_payload['user']['login'] != username:
+            continue
+
+        if (comment := _from_api_payload(comment_payload)) and comment.headers:
+            yield comment
+
+def _user_comments(github: GithubApi, issue_url: IssueUrl, username: str, *, graphql: bool) -> Iterator[GitHubComment]:
+    """The comments made by a user that have a header, in the order they are searched"""
+
+    if graphql:
+        try:
+            yield from _comments_graphql(github, issue_url, username)
+            return
+        except GraphQLUnavailable as e:
+            debug(f'Unable to find comment using graphql: {e}')
+
+    yield from _comments_rest(github, issue_url, username)
+
+def new_comment(issue_url: IssueUrl, headers: dict[str, Optional[str]]) -> GitHubComment:
+    """A PR comment yet to be created"""
+
+    return GitHubComment(
+        issue_url=issue_url,
+        comment_url=None,
+        headers={k: v for k, v in headers.items() if v is not None},
+        body='',
+    )
+
+def find_comment(github: GithubApi, issue_url: IssueUrl, username: str, headers: dict[str, str], *, graphql: bool = False) -> GitHubComment:
     """
     Find a github comment that matches the given headers
 
@@ -138,32 +281,55 @@ def find_comment(github: GithubApi, issue_url: IssueUrl, username: str, headers:
     :param issue_url: The issue to find the comment in
     :param username: The user who made the comment
     :param headers: The headers that must be present on the comment
+    :param graphql: If the token can use the GraphQL API, which finds the newest matching comment with fewer requests
     """
 
     debug(f"Searching for comment with {headers=}")
 
-    for comment_payload in github.paged_get(issue_url + '/comments', params={'per_page': 100}):
-        if comment_payload['user']['login'] != username:
-            continue
+    for comment in _user_comments(github, issue_url, username, graphql=graphql):
+        if matching_headers(comment, headers):
+            debug(f'Found comment that matches headers {comment.headers=} ')
+            return comment
 
-        if comment := _from_api_payload(comment_payload):
+        debug(f"Didn't match comment with {comment.headers=}")
 
-            if comment.headers:
-                # Match by headers only
+    debug('No existing comment exists')
+    return new_comment(issue_url, headers)
 
-                if matching_headers(comment, headers):
-                    debug(f'Found comment that matches headers {comment.headers=} ')
-                    return comment
+def find_comments(
+    github: GithubApi,
+    issue_url: IssueUrl,
+    username: str,
+    headers: dict[str, str],
+    key: str,
+    *,
+    graphql: bool = False,
+    until: Optional[Callable[[dict[Optional[str], GitHubComment]], bool]] = None,
+) -> dict[Optional[str], GitHubComment]:
+    """
+    Find every github comment that matches the given headers, by the value of their `key` header
 
-                debug(f"Didn't match comment with {comment.headers=}")
+    The comments are all found in one search of the issue, instead of a search for each.
+    Where comments have the same value, the one find_comment would find is used.
+    Comments without the `key` header are under None.
 
-    debug('No existing comment exists')
-    return GitHubComment(
-        issue_url=issue_url,
-        comment_url=None,
-        headers={k: v for k, v in headers.items() if v is not None},
-        body='',
-    )
+    :param key: The header that tells the matching comments apart
+    :param until: Stops the search early once it is true of the comments found so far
+    """
+
+    debug(f"Searching for comments with {headers=}, by {key}")
+
+    found = {}
+
+    for comment in _user_comments(github, issue_url, username, graphql=graphql):
+        if matching_headers(comment, headers):
+            found.setdefault(comment.headers.get(key), comment)
+
+            if until is not None and until(found):
+                break
+
+    debug(f'Found comments for {key}={sorted(map(str, found))}')
+    return found
 
 
 def update_comment(
@@ -174,16 +340,25 @@ def update_comment(
     body: str = None,
 ) -> GitHubComment:
 
-    new_headers = headers if headers is not None else comment.headers
+    new_headers = dict(headers if headers is not None else comment.headers)
     new_headers['version'] = version
 
+    new_body = body if body is not None else comment.body
+    new_headers['digest'] = comment_digest(new_headers, new_body)
+
     new_comment = GitHubComment(
         issue_url=comment.issue_url,
         comment_url=comment.comment_url,
         headers=new_headers,
-        body=body if body is not None else comment.body,
+        body=new_body,
     )
 
+    # The digest is worked out from the fetched comment, as its body could have been edited without changing the headers
+    if comment.comment_url is not None and comment_digest(comment.headers, comment.body) == new_headers['digest']:
+        debug(f'Comment {comment.comment_url} is unchanged, not updating it')
+        metrics.increment('github.comment.skipped_writes')
+        return new_comment
+
     if comment.comment_url is not None:
         response = github.patch(comment.comment_url, json={'body': _to_api_payload(new_comment)})
         response.raise_for_status()
@@ -0,0 +1,251 @@
+import dataclasses
+import hashlib
+import re
+import threading
+import logging
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+from cache import cache_dir, read_json, write_json
+
+logger = logging.getLogger(__name__)
+debug = logger.debug
+
+stacks_path = Path('stacks.yaml')
+
+class ConfigError(Exception):
+    """stacks.yaml is not valid"""
+
+    def __init__(self, errors: list[str]):
+        super().__init__('stacks.yaml is not valid:\n' + '\n'.join(f'  {error}' for error in errors))
+        self.errors = errors
+
+@dataclass
+class Stack:
+    account_id: str
+    account_name: str
+    stack_name: str
+    template_path: Path
+    depends_on: list[str] = field(default_factory=list)
+    parameters: dict[str, str] = field(default_factory=dict)
+    template_body: Optional[str] = field(default=None, repr=False, compare=False)
+
+    @property
+    def key(self) -> str:
+        """Identifies the stack in stacks.yaml, as '<account-name>/<stack-name>'"""
+        return f'{self.account_name}/{self.stack_name}'
+
+    def template(self) -> str:
+        """The template body, read from the template path if it hasn't been already"""
+
+        if self.template_body is None:
+            self.template_body = self.template_path.read_text()
+        return self.template_body
+
+_stack_name_re = re.compile(r'^[A-Za-z][-A-Za-z0-9]{0,127}$')
+_account_id_re = re.compile(r'^\d{12}$')
+
+def validate(config: Any) -> list[str]:
+    """
+    Check the whole of stacks.yaml
+
+    :returns: A description of every problem found
+    """
+
+    if not isinstance(config, dict):
+        return ['stacks.yaml must be a mapping of account names to accounts']
+
+    errors = []
+    stack_keys = set()
+    deployed = {}
+
+    for account_name, account in config.items():
+        if not isinstance(account, dict):
+            errors.append(f'{account_name}: must be a mapping with account-id and stacks')
+            continue
+
+        for key in account.keys() - {'account-id', 'stacks'}:
+            errors.append(f'{account_name}: unknown key {key!r}')
+
+        account_id = account.get('account-id')
+        if not isinstance(account_id, str) or not _account_id_re.match(account_id):
+            errors.append(f'{account_name}: account-id must be a quoted 12 digit account id, not {account_id!r}')
+
+        stacks = account.get('stacks')
+        if not isinstance(stacks, list):
+            errors.append(f'{account_name}: stacks must be a list')
+            continue
+
+        for index, stack in enumerate(stacks):
+            if not isinstance(stack, dict):
+                errors.append(f'{account_name}: stack {index} must be a mapping')
+                continue
+
+            name = stack.get('name')
+            where = f'{account_name}/{name}' if isinstance(name, str) else f'{account_name}: stack {index}'
+
+            for key in stack.keys() - {'name', 'template', 'depends-on', 'parameters'}:
+                errors.append(f'{where}: unknown key {key!r}')
+
+            if not isinstance(name, str) or not _stack_name_re.match(name):
+                errors.append(f'{where}: name must be a valid CloudFormation stack name, not {name!r}')
+            elif f'{account_name}/{name}' in stack_keys:
+                errors.append(f'{where}: is defined more than once')
+            else:
+                stack_keys.add(f'{account_name}/{name}')
+
+                if (account_id, name) in deployed:
+                    errors.append(f'{where}: is the same stack as {deployed[account_id, name]}')
+                deployed[account_id, name] = where
+
+            template = stack.get('template')
+            if not isinstance(template, str):
+                errors.append(f'{where}: template must be a path')
+            elif not Path(template).is_file():
+                errors.append(f'{where}: template {template} does not exist')
+
+            depends_on = stack.get('depends-on', [])
+            if not isinstance(depends_on, list) or not all(isinstance(dependency, str) for dependency in depends_on):
+                errors.append(f'{where}: depends-on must be a list of stack names')
+
+            parameters = stack.get('parameters', {})
+            if not isinstance(parameters, dict) or any(not isinstance(value, (str, int, float)) for value in parameters.values()):
+                # Anything else, e.g. an unquoted date, can't be passed to CloudFormation as it was written
+                errors.append(f'{where}: parameters must be a mapping of parameter names to strings, numbers or booleans')
+
+    if errors:
+        return errors
+
+    stacks = list(_stacks(config))
+
+    for stack in stacks:
+        for dependency in stack.depends_on:
+            if dependency not in stack_keys:
+                errors.append(f'{stack.key}: depends on {dependency}, which is not defined')
+
+    if not errors and (cycle := _find_cycle(stacks)):
+        errors.append(f'Circular dependency between stacks: {" -> ".join(cycle)}')
+
+    return errors
+
+def _find_cycle(stacks: list[Stack]) -> Optional[list[str]]:
+    dependencies = {stack.key: stack.depends_on for stack in stacks}
+    visited = set()
+
+    def visit(key: str, path: list[str]) -> Optional[list[str]]:
+        if key in path:
+            return path[path.index(key):] + [key]
+        if key in visited:
+            return None
+        visited.add(key)
+
+        for dependency in dependencies[key]:
+            if cycle := visit(dependency, path + [key]):
+                return cycle
+        return None
+
+    for key in dependencies:
+        if cycle := visit(key, []):
+            return cycle
+    return None
+
+def parameter_value(value: Any) -> str:
+    """
+    A parameter value as CloudFormation expects it
+
+    >>> parameter_value(True)
+    'true'
+    """
+
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+def _stacks(config: dict[str, Any]) -> Iterable[Stack]:
+    for account_name, account in config.items():
+        account_id = account['account-id']
+        for stack in account['stacks']:
+            stack_name = stack['name']
+            template_path = Path(stack['template'])
+
+            # Dependencies are '<account-name>/<stack-name>', or just '<stack-name>' for a stack in the same account
+            depends_on = [
+                dependency if '/' in dependency else f'{account_name}/{dependency}'
+                for dependency in stack.get('depends-on', [])
+            ]
+
+            parameters = {str(key): parameter_value(value) for key, value in stack.get('parameters', {}).items()}
+
+            yield Stack(account_id, account_name, stack_name, template_path, depends_on, parameters)
+
+def _parse(content: bytes) -> Any:
+    """Parse stacks.yaml, reusing the result from the cache directory if this content has been parsed before"""
+
+    content_hash = hashlib.sha256(content).hexdigest()
+    cache_path = cache_dir() / 'config' / f'{content_hash}.json'
+
+    if (cached := read_json(cache_path)) is not None:
+        debug(f'Using parsed stacks.yaml from {cache_path}')
+        return cached
+
+    import yaml
+
+    # The C loader is much faster, but isn't always available
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    config = yaml.load(content, Loader=loader)
+
+    # Not everything yaml can represent can be cached as json, but any such value is invalid anyway
+    write_json(cache_path, config)
+
+    return config
+
+_lock = threading.Lock()
+# The stacks from the last stacks.yaml loaded, and the version of the file they were loaded from
+_loaded: Optional[tuple[tuple[Path, int, int], list[Stack]]] = None
+
+def select_stacks(stacks: list[Stack], templates: Iterable[Path]) -> list[Stack]:
+    """The stacks that use one of the templates"""
+
+    selected = {Path(template) for template in templates}
+    return [stack for stack in stacks if stack.template_path in selected]
+
+def load_stacks(path: Path = stacks_path, templates: Optional[Iterable[Path]] = None) -> list[Stack]:
+    """
+    Load and validate the stacks defined in stacks.yaml
+
+    The whole file is validated before anything is returned, so a mistake is found before any stack is deployed.
+    The result is kept until the file changes, or another stacks.yaml is loaded.
+
+    :param path: The path to stacks.yaml
+    :param templates: If given, only the stacks that use one of these templates are returned
+    :returns: The stacks, with their templates already read
+    """
+
+    global _loaded
+
+    # The same relative path can be in a different checkout, e.g. for each event handled by service.py
+    stat = path.stat()
+    version = path.resolve(), stat.st_mtime_ns, stat.st_size
+
+    with _lock:
+        cached_version, stacks = _loaded or (None, [])
+
+        if cached_version != version:
+            config = _parse(path.read_bytes())
+
+            if errors := validate(config):
+                raise ConfigError(errors)
+
+            stacks = list(_stacks(config))
+            _loaded = version, stacks
+
+    if templates is not None:
+        stacks = select_stacks(stacks, templates)
+
+    # Templates can change without stacks.yaml changing, so they are read again for each load
+    stacks = [dataclasses.replace(stack, template_body=None) for stack in stacks]
+    for stack in stacks:
+        stack.template()
+
+    return stacks
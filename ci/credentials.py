@@ -0,0 +1,124 @@
+import datetime
+import os
+import threading
+import logging
+from collections import defaultdict
+from pathlib import Path
+from typing import Optional, TypedDict
+
+import metrics
+from cache import cache_dir, read_json, write_json
+
+logger = logging.getLogger(__name__)
+debug = logger.debug
+
+# Credentials are refreshed when they have less than this long left
+refresh_margin = datetime.timedelta(minutes=5)
+
+class Credentials(TypedDict):
+    AccessKeyId: str
+    SecretAccessKey: str
+    SessionToken: str
+    Expiration: datetime.datetime
+
+def expires_soon(credentials: Credentials) -> bool:
+    return credentials['Expiration'] - refresh_margin <= datetime.datetime.now(datetime.timezone.utc)
+
+class CredentialCache:
+    """
+    Credentials for assumed roles, shared between threads
+
+    Credentials are reused until shortly before they expire.
+    Each role is only assumed by one thread at a time, but different roles can be assumed concurrently.
+
+    If a cache_path is given, credentials are also persisted there so they can be reused by later processes.
+    """
+
+    def __init__(self, *, session_name: str = 'aws-users', duration: int = 60 * 60, cache_path: Optional[Path] = None):
+        self._session_name = session_name
+        self._duration = duration
+        self._cache_path = cache_path
+
+        self._lock = threading.Lock()
+        self._role_locks = defaultdict(threading.Lock)
+        self._credentials: dict[str, Credentials] = {}
+        self._sts = None
+
+        if cache_path is not None:
+            self._credentials = self._load(cache_path)
+
+    def _sts_client(self):
+        with self._lock:
+            if self._sts is None:
+                import boto3
+                self._sts = boto3.client('sts')
+                metrics.instrument_boto_client(self._sts)
+            return self._sts
+
+    def _role_lock(self, role_arn: str) -> threading.Lock:
+        with self._lock:
+            return self._role_locks[role_arn]
+
+    def credentials(self, role_arn: str) -> Credentials:
+        """Get current credentials for a role, assuming the role if necessary"""
+
+        with self._role_lock(role_arn):
+            credentials = self._credentials.get(role_arn)
+
+            if credentials is None or expires_soon(credentials):
+                debug(f'Assuming role {role_arn}')
+
+                with metrics.span('sts.assume_role', role_arn):
+                    credentials = self._sts_client().assume_role(
+                        RoleArn=role_arn,
+                        RoleSessionName=self._session_name,
+                        DurationSeconds=self._duration,
+                    )['Credentials']
+
+                with self._lock:
+                    self._credentials[role_arn] = credentials
+
+                if self._cache_path is not None:
+                    self._save(self._cache_path)
+
+            return credentials
+
+    @staticmethod
+    def _load(path: Path) -> dict[str, Credentials]:
+        cached = read_json(path) or {}
+
+        credentials = {}
+        for role_arn, c in cached.items():
+            try:
+                credentials[role_arn] = Credentials(
+                    AccessKeyId=c['AccessKeyId'],
+                    SecretAccessKey=c['SecretAccessKey'],
+                    SessionToken=c['SessionToken'],
+                    Expiration=datetime.datetime.fromisoformat(c['Expiration']),
+                )
+            except (KeyError, TypeError, ValueError):
+                continue
+
+        return {role_arn: c for role_arn, c in credentials.items() if not expires_soon(c)}
+
+    def _save(self, path: Path) -> None:
+        with self._lock:
+            cached = {
+                role_arn: {**c, 'Expiration': c['Expiration'].isoformat()}
+                for role_arn, c in self._credentials.items()
+                if not expires_soon(c)
+            }
+
+        write_json(path, cached)
+
+def credential_cache() -> CredentialCache:
+    """
+    Create the credential cache for this process
+
+    Credentials are only persisted to disk if PERSIST_CREDENTIALS is set.
+    """
+
+    if os.environ.get('PERSIST_CREDENTIALS'):
+        return CredentialCache(cache_path=cache_dir() / 'credentials.json')
+
+    return CredentialCache()
@@ -1,10 +1,13 @@
+import itertools
 import json
 import os
 import re
 import logging
+from pathlib import Path
 from typing import Optional, Any, cast, Iterable, Tuple
 
 from api import PrUrl, GithubApi, IssueUrl
+from cache import cache_dir, read_json, write_json
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
@@ -15,6 +18,38 @@ class WorkflowException(Exception):
     """An exception that should result in an error in the workflow log"""
 
 
+def pr_index_path() -> Path:
+    return cache_dir() / 'pr-index.json'
+
+
+def indexed_pr(repo: str, commit: str) -> Optional[Tuple[PrUrl, IssueUrl]]:
+    """Find the merged PR for a commit in the local index"""
+
+    index = read_json(pr_index_path()) or {}
+
+    if found := index.get(repo, {}).get(commit):
+        pr_url, issue_url = found
+        return cast(PrUrl, pr_url), cast(IssueUrl, issue_url)
+
+    return None
+
+
+def update_pr_index(repo: str, prs: dict[str, Tuple[PrUrl, IssueUrl]]) -> None:
+    """
+    Add merged PRs to the local index
+
+    :param repo: The repo the PRs are in
+    :param prs: The PRs found, by their merge commit
+    """
+
+    if not prs:
+        return
+
+    index = read_json(pr_index_path()) or {}
+    index.setdefault(repo, {}).update(prs)
+    write_json(pr_index_path(), index)
+
+
 def find_pr(github: GithubApi) -> Tuple[PrUrl, IssueUrl]:
     """
     Find the pull request this event is related to
@@ -31,18 +66,42 @@ def find_pr(github: GithubApi) -> Tuple[PrUrl, IssueUrl]:
 
     if event_type.startswith('PULL_REQUEST_'):
         _, pr_number = os.environ['CODEBUILD_WEBHOOK_TRIGGER'].rsplit('/', 1)
-        return cast(PrUrl, f'https://api.github.com/repos/{repo}/pulls/{pr_number}'), cast(IssueUrl, f'https://api.github.com/repos/{repo}/issues/{pr_number}')
+        return cast(PrUrl, f'{github.host}/repos/{repo}/pulls/{pr_number}'), cast(IssueUrl, f'{github.host}/repos/{repo}/issues/{pr_number}')
 
     elif event_type == 'PUSH':
         commit = os.environ.get('CODEBUILD_RESOLVED_SOURCE_VERSION', 'unknown')
 
+        if found := indexed_pr(repo, commit):
+            debug(f'Found PR for {commit} in the local index')
+            return found
+
+        found_prs: dict[str, Tuple[PrUrl, IssueUrl]] = {}
+
+        def merged_prs(prs: Iterable[dict[str, Any]]) -> Iterable[dict[str, Any]]:
+            for pr in prs:
+                # Open PRs have a merge_commit_sha for their test merge commit, which can't be the pushed commit
+                if pr.get('merged_at') is not None and pr['merge_commit_sha'] is not None:
+                    found_prs[pr['merge_commit_sha']] = cast(PrUrl, pr['url']), cast(IssueUrl, pr['_links']['issue']['href'])
+                yield pr
+
+        def associated_prs() -> Iterable[dict[str, Any]]:
+            response = github.get(f'{github.host}/repos/{repo}/commits/{commit}/pulls')
+            if response.ok:
+                yield from response.json()
+            else:
+                debug(f'Unable to get the PRs associated with {commit}')
+
         def prs() -> Iterable[dict[str, Any]]:
-            url = cast(PrUrl, f'https://api.github.com/repos/{repo}/pulls')
+            url = cast(PrUrl, f'{github.host}/repos/{repo}/pulls')
             yield from github.paged_get(url, params={'state': 'all'})
 
-        for pr in prs():
-            if pr['merge_commit_sha'] == commit:
-                return cast(PrUrl, pr['url']), cast(IssueUrl, pr['_links']['issue']['href'])
+        try:
+            # Try the PRs associated with the commit first, only scanning every PR if that doesn't find it
+            for pr in itertools.chain(merged_prs(associated_prs()), merged_prs(prs())):
+                if pr['merge_commit_sha'] == commit:
+                    return cast(PrUrl, pr['url']), cast(IssueUrl, pr['_links']['issue']['href'])
+        finally:
+            update_pr_index(repo, found_prs)
 
         raise WorkflowException(f'No PR found in {repo} for commit {commit} (was it pushed directly to the target branch?)')
 
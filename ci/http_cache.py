@@ -0,0 +1,145 @@
+import base64
+import hashlib
+import os
+import threading
+import logging
+from pathlib import Path
+from typing import Optional, Any
+
+from requests import Response
+
+import metrics
+from cache import read_json, write_json
+
+logger = logging.getLogger(__name__)
+debug = logger.debug
+
+# Response headers that are needed to use a cached response.
+# Link isn't one of them: a page can be unchanged while later pages are added, so only a fresh Link header is right.
+_cached_headers = ['content-type', 'etag', 'last-modified']
+
+class HttpCache:
+    """
+    An on-disk cache of GET responses, for making conditional requests
+
+    Responses are stored with their ETag and Last-Modified validators.
+    When a request is repeated, the validators are sent as If-None-Match and If-Modified-Since headers.
+    If the server responds with 304 Not Modified, the cached response is used instead.
+    GitHub doesn't count 304 responses against the rate limit.
+
+    The cache is bounded by the total size of the entries, and the least recently used entries are evicted first.
+    """
+
+    def __init__(self, path: Path, max_size: int):
+        self._path = path
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._size: Optional[int] = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_path(self, key: str) -> Path:
+        return self._path / f'{hashlib.sha256(key.encode()).hexdigest()}.json'
+
+    def conditional_headers(self, key: str) -> dict[str, str]:
+        """Get the headers to make a request conditional on the cached response"""
+
+        entry = read_json(self._entry_path(key))
+        if entry is None:
+            return {}
+
+        headers = {}
+        if etag := entry['headers'].get('etag'):
+            headers['if-none-match'] = etag
+        if last_modified := entry['headers'].get('last-modified'):
+            headers['if-modified-since'] = last_modified
+        return headers
+
+    def update(self, key: str, response: Response) -> Response:
+        """
+        Update the cache with a response
+
+        If the response is 304 Not Modified, it is changed to be the cached response.
+        Headers sent with the 304 are kept, and only the missing ones are taken from the cache.
+        """
+
+        entry_path = self._entry_path(key)
+
+        if response.status_code == 304 and (entry := read_json(entry_path)) is not None:
+            response.status_code = 200
+            for name in _cached_headers:
+                if name in entry['headers'] and name not in response.headers:
+                    response.headers[name] = entry['headers'][name]
+            response._content = base64.b64decode(entry['body'])
+            response.from_cache = True
+
+            try:
+                os.utime(entry_path)
+            except OSError:
+                pass
+
+            with self._lock:
+                self.hits += 1
+            metrics.increment('github.cache.hits')
+            debug(f'HTTP cache hit for {response.url} ({self.hits} hits, {self.misses} misses)')
+            return response
+
+        response.from_cache = False
+
+        with self._lock:
+            self.misses += 1
+        metrics.increment('github.cache.misses')
+        debug(f'HTTP cache miss for {response.url} ({self.hits} hits, {self.misses} misses)')
+
+        if response.status_code == 200 and ('etag' in response.headers or 'last-modified' in response.headers):
+            self._store(entry_path, {
+                'headers': {name: response.headers[name] for name in _cached_headers if name in response.headers},
+                'body': base64.b64encode(response.content).decode(),
+            })
+
+        return response
+
+    def _store(self, entry_path: Path, entry: dict[str, Any]) -> None:
+        write_json(entry_path, entry)
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(path.stat().st_size for path in self._entries())
+            else:
+                self._size += entry_path.stat().st_size if entry_path.exists() else 0
+
+            if self._size > self._max_size:
+                self._evict()
+
+    def _entries(self) -> list[Path]:
+        try:
+            return list(self._path.glob('*.json'))
+        except OSError:
+            return []
+
+    def _evict(self) -> None:
+        """Remove the least recently used entries until the cache is under 90% of the max size"""
+
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+                entries.append((stat.st_mtime, stat.st_size, path))
+            except OSError:
+                continue
+
+        entries.sort()
+        self._size = sum(size for _, size, _ in entries)
+
+        for _, size, path in entries:
+            if self._size <= self._max_size * 0.9:
+                break
+
+            try:
+                path.unlink()
+                self._size -= size
+            except OSError:
+                continue
+
+        debug(f'Evicted HTTP cache entries, the cache is now {self._size} bytes')
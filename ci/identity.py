@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+import logging
+from typing import NamedTuple, Optional
+
+from api import GithubApi
+from cache import cache_dir, read_json, write_json
+
+logger = logging.getLogger(__name__)
+debug = logger.debug
+
+# How long a resolved identity is remembered on disk, in seconds
+identity_ttl = int(os.environ.get('GITHUB_IDENTITY_TTL', 24 * 60 * 60))
+
+class Identity(NamedTuple):
+    login: str
+
+    # How the login was found, 'graphql' or 'rest'
+    method: str
+
+    @property
+    def graphql(self) -> bool:
+        """Can the token use the GraphQL API"""
+        return self.method == 'graphql'
+
+_lock = threading.Lock()
+_identities: dict[str, Identity] = {}
+
+def _graphql(github: GithubApi) -> Optional[str]:
+    response = github.post(f'{github.host}/graphql', json={
+        'query': "query { viewer { login } }"
+    })
+
+    if response.ok:
+        try:
+            return response.json()['data']['viewer']['login']
+        except Exception:
+            pass
+
+    debug(f'Failed to get current user from graphql: {response.status_code}')
+    return None
+
+def _rest(github: GithubApi) -> Optional[str]:
+    response = github.get(f'{github.host}/user')
+
+    if response.ok:
+        return response.json()['login']
+
+    debug(f'Failed to get current user from rest: {response.status_code}')
+    return None
+
+def _identities_path():
+    return cache_dir() / 'identities.json'
+
+def _cached_identity(token_digest: str) -> tuple[Optional[Identity], Optional[str]]:
+    """
+    Get a remembered identity for a token
+
+    :returns: The identity if it is still fresh, and the method that worked last time even if it is stale
+    """
+
+    if identity := _identities.get(token_digest):
+        return identity, identity.method
+
+    cached = (read_json(_identities_path()) or {}).get(token_digest)
+    if not isinstance(cached, dict):
+        return None, None
+
+    try:
+        identity = Identity(cached['login'], cached['method'])
+        resolved_at = float(cached['resolved_at'])
+    except (KeyError, TypeError, ValueError):
+        return None, None
+
+    if time.time() - resolved_at > identity_ttl:
+        return None, identity.method
+
+    return identity, identity.method
+
+def _remember(token_digest: str, identity: Identity) -> None:
+    _identities[token_digest] = identity
+
+    cached = read_json(_identities_path()) or {}
+    cached[token_digest] = {'login': identity.login, 'method': identity.method, 'resolved_at': time.time()}
+    write_json(_identities_path(), cached)
+
+def token_identity(github: GithubApi) -> Identity:
+    """
+    Get the login for the github token, and how it was found
+
+    Not all tokens can be used with graphql.
+    There is also no rest endpoint that can get the current login for app tokens :(
+    Graphql is tried first, then rest (e.g. for fine-grained PATs).
+
+    The identity is remembered for the token, in memory and on disk for GITHUB_IDENTITY_TTL seconds.
+    When it needs resolving again, the method that worked last time is tried first.
+    """
+
+    token_digest = github.token_digest
+
+    with _lock:
+        identity, method = _cached_identity(token_digest)
+
+        if identity is not None:
+            debug(f'token username is {identity.login} (cached)')
+            return identity
+
+        methods = {'graphql': _graphql, 'rest': _rest}
+        order = sorted(methods, key=lambda name: name != method)
+
+        for name in order:
+            if login := methods[name](github):
+                identity = Identity(login, name)
+                _remember(token_digest, identity)
+                debug(f'token username is {login}')
+                return identity
+
+    debug('Unable to get username for the github token')
+    return Identity('unknown', 'unknown')
@@ -0,0 +1,95 @@
+"""
+Check how long the CodeBuild entry points take to import
+
+Each entry point is imported in a fresh interpreter with `python -X importtime`.
+This fails if an entry point imports a module it shouldn't need at startup.
+Taking longer than the budget is only a warning, as timings vary with the machine, unless --strict is given.
+
+    python3 ci/importtime.py [--strict]
+"""
+
+import argparse
+import re
+import subprocess
+import sys
+from pathlib import Path
+from typing import NamedTuple
+
+class Budget(NamedTuple):
+    # The longest the import can take, in milliseconds
+    milliseconds: int
+
+    # Packages that must only be imported when they are first used
+    lazy: list[str]
+
+budgets = {
+    'main': Budget(milliseconds=150, lazy=['boto3', 'botocore', 'requests', 'yaml']),
+    'pr': Budget(milliseconds=400, lazy=['boto3', 'botocore', 'yaml']),
+}
+
+# The best of this many runs is used, to reduce noise
+runs = 3
+
+_line_re = re.compile(r'^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \|(?P<indent>\s*)(?P<module>\S+)$')
+
+def import_time(module: str) -> tuple[float, set[str]]:
+    """
+    Import a module in a fresh interpreter
+
+    :returns: The cumulative import time in milliseconds, and the names of every module imported
+    """
+
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=Path(__file__).parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    cumulative = None
+    imported = set()
+
+    for line in result.stderr.splitlines():
+        if match := _line_re.match(line):
+            imported.add(match['module'])
+            if match['module'] == module and len(match['indent']) == 1:
+                cumulative = int(match['cumulative']) / 1000
+
+    if cumulative is None:
+        raise Exception(f'No import time found for {module}')
+
+    return cumulative, imported
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Check how long the CodeBuild entry points take to import')
+    parser.add_argument('--strict', action='store_true', help='Also fail if an entry point takes longer than its budget')
+    args = parser.parse_args()
+
+    failed = False
+
+    for module, budget in budgets.items():
+        times = []
+        imported = set()
+
+        for _ in range(runs):
+            milliseconds, imported = import_time(module)
+            times.append(milliseconds)
+
+        best = min(times)
+        eager = sorted(name for name in imported if name.split('.')[0] in budget.lazy and '.' not in name)
+
+        print(f'{module}: {best:.1f}ms (budget {budget.milliseconds}ms)')
+
+        if best > budget.milliseconds:
+            print(f'  {"Error" if args.strict else "Warning"}: {module} takes longer than {budget.milliseconds}ms to import')
+            failed = failed or args.strict
+
+        if eager:
+            print(f'  Error: {module} imports {", ".join(eager)} at startup')
+            failed = True
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,41 +1,190 @@
 import logging
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple
 
-from pr import create_all_changesets, wait_for_changesets, is_failed, Stack, Changeset, cloudformation, has_changes
+import metrics
+from changesets import create_all_changesets, wait_for_changesets, is_failed, Stack, Changeset, cloudformation, has_changes, failed_changeset, defined_stacks, planned_changeset, changeset_concurrency, changeset_name_prefix
+from stack_events import StackWatcher
 
 logging.basicConfig()
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 debug = logger.debug
 
+# How many accounts can have changesets executing at once
+apply_concurrency = int(os.environ.get('APPLY_CONCURRENCY', 8))
+
+# Execute the changesets planned on the PR when they are still current, instead of creating them again
+reuse_planned_changesets = os.environ.get('REUSE_PLANNED_CHANGESETS', 'true').lower() != 'false'
+
 def execute_changeset(stack: Stack, changeset: Changeset) -> None:
     logger.info(f"Apply changeset for {stack.account_name}/{stack.stack_name}...")
 
-    response = cloudformation.changeset_executor(stack.account_id).execute_change_set(
+    cloudformation().changeset_executor(stack.account_id).execute_change_set(
         ChangeSetName=changeset['ChangeSetId']
     )
 
-    logger.info(response)
+def execution_waves(changesets: list[Tuple[Stack, Changeset]]) -> list[list[Tuple[Stack, Changeset]]]:
+    """
+    Group changesets into waves that can be executed concurrently
+
+    Every stack is in a later wave than the stacks it depends on.
+    Dependencies on stacks that have no changeset (because they have no changes) are already satisfied.
+    """
+
+    remaining = {stack.key: (stack, changeset) for stack, changeset in changesets}
+    waves = []
+
+    while remaining:
+        wave = [
+            (stack, changeset) for stack, changeset in remaining.values()
+            if not any(dependency in remaining for dependency in stack.depends_on)
+        ]
+
+        if not wave:
+            raise Exception(f'Circular dependency between stacks: {", ".join(remaining)}')
+
+        for stack, _ in wave:
+            del remaining[stack.key]
+
+        waves.append(wave)
+
+    return waves
+
+def execute_account_changesets(changesets: list[Tuple[Stack, Changeset]], watcher: StackWatcher) -> list[Tuple[Stack, Changeset]]:
+    """
+    Execute the changesets for a single account, one at a time in order
+
+    Each changeset is executed once the stack update from the previous one has finished.
+    """
+
+    results = []
 
-def execute_all_changesets(changesets: list[Tuple[Stack, Changeset]]) -> None:
     for stack, changeset in changesets:
+        try:
+            with metrics.span('stack.apply', stack.key):
+                operation = watcher.watch(stack, changeset['StackId'])
+
+                try:
+                    execute_changeset(stack, changeset)
+                    operation.wait()
+                finally:
+                    # Already done if the operation finished, but not if it failed to start or timed out
+                    watcher.unwatch(operation)
+
+            changeset = Changeset(**{
+                **changeset,
+                'ExecutionStatus': 'EXECUTE_COMPLETE' if operation.succeeded else 'EXECUTE_FAILED',
+                'StatusReason': operation.reason,
+            })
+
+            if not operation.succeeded:
+                logger.error(f'Update of {stack.key} finished with {operation.status}: {operation.reason}')
+        except Exception as e:
+            logger.exception(f"Failed to execute changeset for {stack.key}")
+            changeset = failed_changeset(stack, str(e))
+
+        results.append((stack, changeset))
+
+    return results
+
+def execute_all_changesets(changesets: list[Tuple[Stack, Changeset]]) -> list[Tuple[Stack, Changeset]]:
+    """
+    Execute changesets in dependency order
 
-        if is_failed(changeset):
-            logger.error(f"Changeset for {stack.account_name}/{stack.stack_name} failed")
-            continue
+    Each wave of independent stacks is executed concurrently, with the stacks in the same account executed in turn.
+    The stack updates are all watched from one StackWatcher.
+    If a changeset fails, the stacks that depend on it (directly or indirectly) are not executed.
 
-        execute_changeset(stack, changeset)
+    :returns: The final state of each changeset, in the same order
+    """
+
+    results = {}
+    failed = set()
+
+    with StackWatcher() as watcher:
+        for wave in execution_waves(changesets):
+            by_account = defaultdict(list)
+
+            for stack, changeset in wave:
+                if is_failed(changeset):
+                    logger.error(f"Changeset for {stack.key} failed")
+                    failed.add(stack.key)
+                    results[stack.key] = changeset
+                elif failed_dependencies := [dependency for dependency in stack.depends_on if dependency in failed]:
+                    logger.error(f"Not applying changeset for {stack.key} because {', '.join(failed_dependencies)} failed")
+                    failed.add(stack.key)
+                    results[stack.key] = failed_changeset(stack, f'Not applied because {", ".join(failed_dependencies)} failed')
+                else:
+                    by_account[stack.account_id].append((stack, changeset))
+
+            with ThreadPoolExecutor(max_workers=apply_concurrency, thread_name_prefix='apply') as executor:
+                for account_results in executor.map(lambda account_changesets: execute_account_changesets(account_changesets, watcher), by_account.values()):
+                    for stack, changeset in account_results:
+                        if is_failed(changeset):
+                            failed.add(stack.key)
+                        results[stack.key] = changeset
+
+    return [(stack, results[stack.key]) for stack, _ in changesets]
+
+def planned_changesets(stacks: list[Stack]) -> dict[str, Changeset]:
+    """
+    Find the changesets planned on the merged PR that can still be executed
+
+    The PR comment records the changeset created for each stack, and the digest of the template it was created from.
+    As the comment can be edited, each changeset is only used if it was created by a build of this PR for the same stack,
+    from the template and parameters the stack has now, and is still available.
+    If the planned changesets can't be found, every stack is planned again.
+
+    :returns: The changesets that can be executed, by stack key
+    """
+
+    if not reuse_planned_changesets:
+        return {}
+
+    try:
+        # Only needed to find the PR, so not imported at startup
+        from find_pr import find_pr
+        from pr import github_api, find_comments, planned_changesets as recorded_changesets
+
+        _, issue_url = find_pr(github_api())
+        recorded = recorded_changesets(find_comments(issue_url))
+    except Exception:
+        logger.exception('Unable to find the changesets planned on the PR')
+        return {}
+
+    # Changesets created by the PR build are named after its webhook trigger
+    name_prefix = changeset_name_prefix(f"pr/{issue_url.rsplit('/', 1)[1]}")
+
+    planned = [(stack, *recorded[stack.key], name_prefix) for stack in stacks if stack.key in recorded]
+
+    with ThreadPoolExecutor(max_workers=changeset_concurrency, thread_name_prefix='planned') as executor:
+        changesets = executor.map(lambda args: planned_changeset(*args), planned)
+        return {stack.key: changeset for (stack, *_), changeset in zip(planned, changesets) if changeset is not None}
 
 def main():
-    changesets = create_all_changesets()
-    changesets = wait_for_changesets(changesets)
+    try:
+        apply()
+    finally:
+        metrics.report()
 
-    changesets = [(stack, changeset) for stack, changeset in changesets if has_changes(changeset)]
+def apply():
+    stacks = list(defined_stacks())
+
+    with metrics.span('changeset.reuse'):
+        planned = planned_changesets(stacks)
+    logger.info(f'Reusing the planned changesets for {len(planned)} of {len(stacks)} stacks')
 
-    # At this point we can compare the contents of the changeset with the one on the Pr to see if they match
+    # Stacks without a current planned changeset are planned again
+    stale = [stack for stack in stacks if stack.key not in planned]
+    created = {stack.key: changeset for stack, changeset in wait_for_changesets(create_all_changesets(stale))}
+
+    changesets = [(stack, planned.get(stack.key) or created[stack.key]) for stack in stacks]
+    changesets = [(stack, changeset) for stack, changeset in changesets if has_changes(changeset)]
 
-    execute_all_changesets(changesets)
-    changesets = wait_for_changesets(changesets)
+    changesets = execute_all_changesets(changesets)
 
     if any(is_failed(changeset) for _, changeset in changesets):
         raise Exception("One or more changesets failed")
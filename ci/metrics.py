@@ -0,0 +1,145 @@
+import json
+import os
+import sys
+import threading
+import time
+import logging
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# Where the JSON report is written at the end of a run, empty to not write one.
+# A relative path is resolved now, as service.py handles each event in a temporary directory.
+report_path = os.environ.get('METRICS_REPORT', 'metrics.json')
+if report_path:
+    report_path = os.path.abspath(report_path)
+
+_lock = threading.Lock()
+_counters: Counter[str] = Counter()
+_started = time.perf_counter()
+
+@dataclass
+class SpanStats:
+    count: int = 0
+    seconds: float = 0
+    max_seconds: float = 0
+
+_spans: dict[str, SpanStats] = defaultdict(SpanStats)
+
+# The time spent in each span by what it was for, e.g. a stack or account
+_subjects: dict[str, Counter[str]] = defaultdict(Counter)
+
+def increment(name: str, amount: int = 1) -> None:
+    """Add to a counter for this run"""
+
+    with _lock:
+        _counters[name] += amount
+
+def counters() -> dict[str, int]:
+    with _lock:
+        return dict(_counters)
+
+def record(name: str, seconds: float, subject: Optional[str] = None) -> None:
+    """Record the time taken by one occurrence of a span"""
+
+    with _lock:
+        stats = _spans[name]
+        stats.count += 1
+        stats.seconds += seconds
+        stats.max_seconds = max(stats.max_seconds, seconds)
+
+        if subject is not None:
+            _subjects[name][subject] += seconds
+
+@contextmanager
+def span(name: str, subject: Optional[str] = None) -> Iterator[None]:
+    """
+    Time a block of code
+
+    :param name: What is being done, spans with the same name are added together
+    :param subject: What it is being done for, so the slowest can be found
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start, subject)
+
+def instrument_boto_client(client: Any, subject: Optional[str] = None) -> None:
+    """
+    Record every call made by a boto3 client
+
+    Each call is recorded as an 'aws.<service>.<operation>' span, including any retries,
+    and the requests, retries and response bytes are counted.
+    """
+
+    service = client.meta.service_model.service_name
+
+    def before_call(context: dict[str, Any], **kwargs: Any) -> None:
+        context['metrics_started'] = time.perf_counter()
+
+    def after_call(http_response: Any, parsed: dict[str, Any], model: Any, context: dict[str, Any], **kwargs: Any) -> None:
+        if 'metrics_started' in context:
+            record(f'aws.{service}.{model.name}', time.perf_counter() - context['metrics_started'], subject)
+
+        increment('aws.requests')
+        increment('aws.retries', parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+        increment('aws.bytes', len(http_response.content or b''))
+
+    client.meta.events.register('before-call', before_call)
+    client.meta.events.register('after-call', after_call)
+
+def summary() -> dict[str, Any]:
+    """Everything recorded in this run"""
+
+    with _lock:
+        return {
+            'command': ' '.join(sys.argv),
+            'seconds': time.perf_counter() - _started,
+            'counters': dict(sorted(_counters.items())),
+            'spans': {name: asdict(stats) for name, stats in sorted(_spans.items())},
+            'subjects': {
+                name: dict(subjects.most_common())
+                for name, subjects in sorted(_subjects.items())
+            },
+        }
+
+def reset() -> None:
+    """Start recording a new run"""
+
+    global _started
+
+    with _lock:
+        _counters.clear()
+        _spans.clear()
+        _subjects.clear()
+        _started = time.perf_counter()
+
+def report() -> None:
+    """Log a summary of this run, and write the full report to METRICS_REPORT"""
+
+    run = summary()
+
+    logger.info(f'Finished in {run["seconds"]:.2f}s')
+
+    logger.info(f'{"span":<45} {"count":>6} {"total s":>9} {"max s":>8}  slowest')
+    for name, stats in sorted(run['spans'].items(), key=lambda item: item[1]['seconds'], reverse=True):
+        slowest = next(iter(run['subjects'].get(name, {}).items()), None)
+        logger.info(
+            f'{name:<45} {stats["count"]:>6} {stats["seconds"]:>9.2f} {stats["max_seconds"]:>8.2f}'
+            + (f'  {slowest[0]} ({slowest[1]:.2f}s)' if slowest else '')
+        )
+
+    for name, value in run['counters'].items():
+        logger.info(f'{name}: {value}')
+
+    if report_path:
+        try:
+            Path(report_path).write_text(json.dumps(run, indent=2))
+        except OSError as e:
+            logger.warning(f'Unable to write the metrics report to {report_path}: {e}')
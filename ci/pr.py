@@ -1,247 +1,360 @@
+import io
 import os
-import time
-from dataclasses import dataclass
-from pathlib import Path
-from typing import Iterable, Tuple, TypedDict, Any, Optional
+import re
+import functools
+from typing import Iterable, Tuple, Optional
 
-import boto3
 import logging
-import yaml
 
-from api import GithubApi
+import metrics
+from api import IssueUrl, GithubApi
+from changesets import Stack, Change, Changeset, create_all_changesets, wait_for_changesets, has_changes, is_failed, is_unchanged, stack_digest
+from config import load_stacks, select_stacks, stacks_path
 from find_pr import find_pr
-from comment import find_comment, update_comment
+from comment import find_comments as find_matching_comments, new_comment, update_comment, collapse_threshold, GitHubComment
+from identity import token_identity
+from selection import planned_templates
 
 logging.basicConfig()
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 debug = logger.debug
 
-github = GithubApi('https://api.github.com', os.environ.get('GITHUB_TOKEN'))
-
-@dataclass
-class Stack:
-    account_id: str
-    account_name: str
-    stack_name: str
-    template_path: Path
-
-class Changeset(TypedDict):
-    ChangeSetName: str
-    ChangeSetId: str
-    StackId: str
-    StackName: str
-    Status: str
-    StatusReason: str
-    Changes: list[dict[str, Any]]
-
-def changeset_name() -> str:
-    return f"{os.environ.get('CODE_BUILD_WEBHOOK_TRIGGER', 'unknown-pr')}-{os.environ.get('CODEBUILD_RESOLVED_SOURCE_VERSION', 'unknown-commit')}-{os.environ.get('CODEBUILD_BUILD_NUMBER', int(time.time()))}"
-
-class Cloudformation:
-    def __init__(self):
-        self._clients = {}
-
-    def cloudformation_client(self, account_id: str, role_name: str):
-
-        role_arn = f'arn:aws:iam::{account_id}:role/{role_name}'
-
-        if role_arn not in self._clients:
-
-            sts = boto3.client('sts').assume_role(
-                RoleArn=f'arn:aws:iam::{account_id}:role/{role_name}',
-                RoleSessionName='aws-users',
-                DurationSeconds=60 * 60,
-            )['Credentials']
-
-            self._clients[role_arn] = boto3.client(
-                'cloudformation',
-                aws_access_key_id=sts.get('AccessKeyId'),
-                aws_secret_access_key=sts.get('SecretAccessKey'),
-                aws_session_token=sts.get('SessionToken'),
-                region_name='eu-west-1'
-            )
-
-        return self._clients[role_arn]
-
-    def changeset_creator(self, account_id: str):
-        return self.cloudformation_client(account_id, 'RoleChangeSetCreator')
-
-    def changeset_executor(self, account_id: str):
-        return self.cloudformation_client(account_id, 'RoleIAMAdministrator')
-
-cloudformation = Cloudformation()
-
-def defined_stacks() -> Iterable[Stack]:
-    for account_name, account in yaml.safe_load(Path('stacks.yaml').read_text()).items():
-        account_id = account['account-id']
-        for stack in account['stacks']:
-            stack_name = stack['name']
-            template_path = Path(stack['template'])
-            yield Stack(account_id, account_name, stack_name, template_path)
-
-
-def create_changeset(stack: Stack) -> Changeset:
-    logger.info(f"Creating changeset for {stack.account_name}/{stack.stack_name}...")
-    response = cloudformation.changeset_creator(stack.account_id).create_change_set(
-        StackName=stack.stack_name,
-        TemplateBody=stack.template_path.read_text(),
-        ChangeSetName=changeset_name(),
-        Capabilities=['CAPABILITY_NAMED_IAM'],
-        Description=f"Changeset generated from an aws-users PR",
-    )
+# The size of the on-disk cache of GitHub responses in bytes, 0 to disable it
+github_cache_size = int(os.environ.get('GITHUB_HTTP_CACHE_SIZE', 50 * 1024 * 1024))
+
+# The maximum number of GitHub API requests a run can make
+github_api_budget = int(os.environ['GITHUB_API_BUDGET']) if 'GITHUB_API_BUDGET' in os.environ else None
+
+# How many pages of a paged GitHub resource can be fetched at once
+github_page_concurrency = int(os.environ.get('GITHUB_PAGE_CONCURRENCY', 4))
 
-    logger.info(response)
+@functools.cache
+def github_api() -> GithubApi:
+    """The GitHub client for this process, created on first use"""
 
-    changeset = cloudformation.changeset_creator(stack.account_id).describe_change_set(
-        ChangeSetName=response['Id'],
+    from api import RequestScheduler
+    from async_api import ConcurrentGithubApi
+    from cache import cache_dir
+    from http_cache import HttpCache
+
+    return ConcurrentGithubApi(
+        os.environ.get('GITHUB_API_URL', 'https://api.github.com'),
+        os.environ.get('GITHUB_TOKEN'),
+        cache=HttpCache(cache_dir() / 'http', github_cache_size) if github_cache_size else None,
+        scheduler=RequestScheduler(budget=github_api_budget),
+        concurrency=github_page_concurrency
     )
-    logger.info(changeset)
-    return changeset
 
+# The longest PR comment body we render. Github rejects comments longer than 65536 characters,
+# this leaves room for the comment header and links to other comments.
+section_length = 60000
+
+def render_change(change: Change) -> Optional[str]:
+    if change.action == 'Add':
+        return f'+ {change.resource_type} {change.logical_id}\n'
+    elif change.action == 'Modify':
+        if change.replacement == 'True':
+            return f'! {change.resource_type} {change.logical_id}\n'
+        else:
+            return f'! {change.resource_type} {change.logical_id}\n'
+    elif change.action == 'Remove':
+        return f'- {change.resource_type} {change.logical_id}\n'
+    elif change.action == 'Dynamic':
+        return f'! Undetermined to {change.resource_type} {change.logical_id}\n'
+    return None
+
+def render_changeset_diff(changeset: Changeset, max_length: int = section_length) -> str:
+    """
+    Render the changes in a changeset as a diff
+
+    If there are more than `collapse_threshold` changes the diff is collapsed.
+    Changes that don't fit in max_length are left out, with a note saying how many.
+    """
+
+    lines = [line for change in changeset.get('Changes', []) if (line := render_change(change)) is not None]
+
+    out = io.StringIO()
+
+    if len(lines) > collapse_threshold:
+        out.write(f'<details><summary>{len(lines)} changes</summary>\n\n')
+
+    out.write('```diff\n')
+
+    # Leave room for closing the diff
+    budget = max_length - out.tell() - 100
+
+    for count, line in enumerate(lines):
+        if len(line) > budget:
+            out.write(f'# ... {len(lines) - count} more changes, view the changeset for the full list\n')
+            break
+        out.write(line)
+        budget -= len(line)
+
+    out.write('```\n')
+
+    if len(lines) > collapse_threshold:
+        out.write('</details>\n')
+
+    return out.getvalue()
+
+def render_changeset(stack: Stack, changeset: Changeset) -> str:
+    out = io.StringIO()
+
+    # Marks where the section for the stack starts, so it can be kept when the stack isn't planned again.
+    # A changeset that can be executed is recorded with the digest of the template it was created from,
+    # so it can be executed when the PR is merged instead of being created again.
+    if changeset['ChangeSetId'] and changeset['Status'] == 'CREATE_COMPLETE':
+        out.write(f'<!-- stack: {stack.key} {changeset["ChangeSetId"]} {stack_digest(stack)} -->\n')
+    else:
+        out.write(f'<!-- stack: {stack.key} -->\n')
+
+    out.write(f"Changeset for __{stack.account_name}/{stack.stack_name}__\n")
 
-def create_all_changesets() -> list[Tuple[Stack, Changeset]]:
-    changesets = []
+    if changeset['Status'] == 'FAILED':
+        out.write(f"Status: {changeset['Status']}: {changeset['StatusReason']}.\n")
+    else:
+        out.write(render_changeset_diff(changeset))
 
-    for stack in defined_stacks():
-        changesets.append((stack, create_changeset(stack)))
+    if changeset['ChangeSetId']:
+        out.write(f'\n[View Changeset](https://eu-west-1.console.aws.amazon.com/cloudformation/home?region=eu-west-1#/stacks/changesets/changes?stackId={changeset["StackId"]}&changeSetId={changeset["ChangeSetId"]})')
 
-    return changesets
+    return out.getvalue()
 
+# Separates the stack sections of a comment body from anything after them
+_sections_end = '<!-- end of stacks -->'
+_stack_marker_re = re.compile(r'<!-- stack: (?P<key>\S+)(?: (?P<changeset_id>\S+) (?P<digest>\w+))? -->')
 
-def wait_for_changesets(changesets: list[Tuple[Stack, Changeset]]) -> list[Tuple[Stack, Changeset]]:
+def render_comments(sections: Iterable[str], unchanged: Iterable[Stack] = ()) -> list[str]:
+    """
+    Render the stack sections as the bodies of one or more PR comments
 
-    ready_changesets = []
+    Each body fits in a github comment, with room left for the comment header and links to the other comments.
+    A section is never split between comments. The list of unchanged stacks follows the sections,
+    continuing in further comments if it doesn't fit.
+    """
 
-    sleep = 1
+    bodies = []
+    out = io.StringIO()
 
-    for stack, changeset in changesets:
-        while True:
-            changeset = cloudformation.changeset_creator(stack.account_id).describe_change_set(
-                ChangeSetName=changeset['ChangeSetId']
-            )
+    def end_body() -> None:
+        if out.tell():
+            out.write(f'\n{_sections_end}')
+        bodies.append(out.getvalue())
 
-            logger.info(changeset)
+    for section in sections:
+        if out.tell() and out.tell() + len(section) > section_length:
+            end_body()
+            out = io.StringIO()
 
-            if changeset.get('Status').endswith('_COMPLETE') or changeset.get('Status').endswith('FAILED'):
-                ready_changesets.append((stack, changeset))
-                break
+        if out.tell():
+            out.write('<hr>\n')
+        out.write(section)
 
-            print(f"Waiting for changeset {stack.account_name}/{stack.stack_name} to be created...")
-            time.sleep(sleep)
-            sleep = min(sleep * 2, 30)
+    if not bodies and not out.tell():
+        out.write('No changes detected')
+    else:
+        out.write(f'\n{_sections_end}')
 
-    return ready_changesets
+    unchanged_stacks = [f'`{stack.key}`' for stack in unchanged]
 
+    while unchanged_stacks:
+        prefix = '\n\nUnchanged: ' if out.tell() else 'Unchanged: '
 
-def has_changes(changeset: Changeset) -> bool:
-    if changeset['Status'] == 'FAILED' and changeset['StatusReason'] == "The submitted information didn't contain changes. Submit different information to create a change set.":
-        print(f'No changes detected in {changeset["StackName"]}')
-        return False
+        # As many stacks as fit in this body, but at least one in an empty body
+        length = out.tell() + len(prefix)
+        count = 0
+        while count < len(unchanged_stacks) and (length + len(unchanged_stacks[count]) + 2 <= section_length or not out.tell() and count == 0):
+            length += len(unchanged_stacks[count]) + 2
+            count += 1
 
-    return True
+        if count:
+            out.write(prefix + ', '.join(unchanged_stacks[:count]))
+            unchanged_stacks = unchanged_stacks[count:]
 
-def is_failed(changeset: Changeset) -> bool:
-    return changeset['Status'] == 'FAILED'
+        if unchanged_stacks:
+            bodies.append(out.getvalue())
+            out = io.StringIO()
 
-def render_changeset_diff(changeset: Changeset) -> str:
+    bodies.append(out.getvalue())
+    return bodies
 
-    s = '```diff\n'
+def previous_sections(comments: Iterable[GitHubComment]) -> dict[str, str]:
+    """Get the stack sections from previously rendered comments, by stack key"""
 
-    for change in changeset.get('Changes', []):
+    sections = {}
 
-        change = change['ResourceChange']
-        if change.get('Action') == 'Add':
-            s += f'+ {change["ResourceType"]} {change["LogicalResourceId"]}\n'
-        elif change.get('Action') == 'Modify':
-            if change.get('Replacement') == 'True':
-                s += f'! {change["ResourceType"]} {change["LogicalResourceId"]}\n'
-            else:
-                s += f'! {change["ResourceType"]} {change["LogicalResourceId"]}\n'
-        elif change.get('Action') == 'Remove':
-            s += f'- {change["ResourceType"]} {change["LogicalResourceId"]}\n'
-        elif change.get('Action') == 'Dynamic':
-            s += f'! Undetermined to {change["ResourceType"]} {change["LogicalResourceId"]}\n'
+    for comment in comments:
+        stacks, found, _ = comment.body.partition(_sections_end)
+        if not found:
+            continue
 
-    s += '```\n'
+        for section in stacks.split('<hr>\n'):
+            section = section[section.find('<!-- stack: '):].strip() + '\n'
+            if match := _stack_marker_re.match(section):
+                sections[match['key']] = section
 
-    return s
+    return sections
 
-def render_changesets(changesets: list[Tuple[Stack, Changeset]]) -> str:
-    s = ''
+def current_sections(comments: Iterable[GitHubComment], stacks: Iterable[Stack]) -> dict[str, str]:
+    """
+    Get the stack sections from previously rendered comments that are still current, by stack key
 
-    for stack, changeset in changesets:
-        if s:
-            s += '<hr>\n'
+    A section is only current if it records the digest of the template and parameters the stack has now.
+    Any other section is from an earlier commit of the PR, e.g. for a change the PR no longer makes.
+    """
 
-        s += f"Changeset for __{stack.account_name}/{stack.stack_name}__\n"
+    previous = previous_sections(comments)
+    sections = {}
 
-        if changeset['Status'] == 'FAILED':
-            s += f"Status: {changeset['Status']}: {changeset['StatusReason']}.\n"
+    for stack in stacks:
+        if (section := previous.get(stack.key)) is None:
+            continue
+
+        if (match := _stack_marker_re.match(section)) and match['digest'] == stack_digest(stack):
+            sections[stack.key] = section
         else:
-            s += render_changeset_diff(changeset)
-        s += f'\n[View Changeset](https://eu-west-1.console.aws.amazon.com/cloudformation/home?region=eu-west-1#/stacks/changesets/changes?stackId={changeset["StackId"]}&changeSetId={changeset["ChangeSetId"]})'
+            debug(f'Dropping the previous plan for {stack.key}, it was not planned from the current template')
+
+    return sections
+
+def planned_changesets(comments: Iterable[GitHubComment]) -> dict[str, Tuple[str, str]]:
+    """
+    Get the changesets recorded in previously rendered comments
+
+    :returns: The changeset id and stack digest, by stack key
+    """
+
+    planned = {}
+
+    for key, section in previous_sections(comments).items():
+        if (match := _stack_marker_re.match(section)) and match['changeset_id']:
+            planned[key] = match['changeset_id'], match['digest']
+
+    return planned
+
+def comment_link(comment: GitHubComment) -> str:
+    comment_id = comment.comment_url.rsplit('/', 1)[-1]
+    return f'#issuecomment-{comment_id}'
+
+def find_comments(issue_url: IssueUrl) -> list[GitHubComment]:
+    """
+    Find the PR comments from an earlier run
+
+    The main comment and every part comment are found in one search of the PR,
+    which stops once every part comment made for the main comment has been found.
 
-    if not s:
-        s = 'No changes detected'
+    :returns: The main comment, followed by each part comment up to the last one found
+    """
 
-    return s
+    github = github_api()
+    identity = token_identity(github)
 
-def current_user() -> str:
-    def graphql() -> Optional[str]:
-        graphql_url = 'https://api.github.com/graphql'
+    def found_all(found: dict[Optional[str], GitHubComment]) -> bool:
+        """Have the main comment and every part comment made for it been found"""
 
-        response = github.post(graphql_url, json={
-            'query': "query { viewer { login } }"
-        })
-        debug(f'graphql response: {response.content}')
+        if (comment := found.get(None)) is None:
+            return False
 
-        if response.ok:
-            try:
-                return response.json()['data']['viewer']['login']
-            except Exception as e:
-                pass
+        # Part comments that are no longer used still exist, so they can be used again
+        created_parts = int(comment.headers.get('created_parts', comment.headers.get('parts', 1)))
+        return all(str(part) in found for part in range(2, created_parts + 1))
 
-        debug('Failed to get current user from graphql')
+    found = find_matching_comments(github, issue_url, identity.login, {}, 'part', graphql=identity.graphql, until=found_all)
 
-    def rest() -> Optional[str]:
-        response = github.get('https://api.github.com/user')
-        debug(f'rest response: {response.content}')
+    comment = found.get(None) or new_comment(issue_url, {})
+    last_part = max([int(comment.headers.get('parts', 1))] + [int(part) for part in found if part is not None and part.isdigit()])
 
-        if response.ok:
-            user = response.json()
+    return [comment] + [
+        found.get(str(part)) or new_comment(issue_url, {'part': str(part)})
+        for part in range(2, last_part + 1)
+    ]
 
-            return user['login']
+def update_comments(comments: list[GitHubComment], bodies: list[str]) -> GitHubComment:
+    """
+    Update the PR comments with the rendered bodies
 
-    # Not all tokens can be used with graphql
-    # There is also no rest endpoint that can get the current login for app tokens :(
-    # Try graphql first, then fallback to rest (e.g. for fine grained PATs)
+    The first body goes in the main comment. Each additional body goes in its own comment with a 'part' header,
+    and the main comment links to them. Part comments left over from an earlier run are marked as no longer used.
 
-    username = graphql() or rest()
+    :param comments: The existing comments, as returned by find_comments
+    :param bodies: The rendered bodies
+    """
 
-    if username is None:
-        debug('Unable to get username for the github token')
-        username = 'unknown'
+    github = github_api()
 
-    debug(f'token username is {username}')
-    return username
+    comment, *previous_parts = comments
+    issue_url = comment.issue_url
 
+    def part_comment(part: int) -> GitHubComment:
+        if part - 2 < len(previous_parts):
+            return previous_parts[part - 2]
+        # find_comments found every existing part, so this one is new
+        return new_comment(issue_url, {'part': str(part)})
+
+    links = []
+    for part, body in enumerate(bodies[1:], start=2):
+        updated = update_comment(github, part_comment(part), headers={'part': str(part)}, body=f'Continued (part {part} of {len(bodies)})\n\n{body}')
+        links.append(f'[part {part}]({comment_link(updated)})')
+
+    for part in range(len(bodies) + 1, len(previous_parts) + 2):
+        if (unused := part_comment(part)).comment_url is not None:
+            update_comment(github, unused, body='This part is no longer used.')
+
+    body = bodies[0]
+    if links:
+        body += f'\n\nContinued in {", ".join(links)}'
+
+    return update_comment(github, comment, headers={
+        **comment.headers,
+        'parts': str(len(bodies)),
+        'created_parts': str(max(len(bodies), len(previous_parts) + 1)),
+    }, body=body)
 
 def main():
-    changesets = create_all_changesets()
+    try:
+        plan()
+    finally:
+        metrics.report()
+
+
+def plan():
+    pr_url, issue_url = find_pr(github_api())
+
+    # Only plan the stacks whose templates are changed by the PR, if we can tell what they are
+    with metrics.span('plan.select'):
+        templates = planned_templates(github_api(), pr_url, stacks_path)
+    defined = load_stacks()
+    stacks = defined if templates is None else select_stacks(defined, templates)
+    debug(f'Planning {", ".join(stack.key for stack in stacks) or "no stacks"}')
+
+    changesets = create_all_changesets(stacks)
     changesets = wait_for_changesets(changesets)
 
+    unchanged = [stack for stack, changeset in changesets if is_unchanged(changeset)]
     changesets = [(stack, changeset) for stack, changeset in changesets if has_changes(changeset)]
 
-    result = render_changesets(changesets)
-    print(result)
+    with metrics.span('render'):
+        sections = {stack.key: render_changeset(stack, changeset) for stack, changeset in changesets}
+
+    with metrics.span('github.find_comments'):
+        comments = find_comments(issue_url)
 
-    pr_url, issue_url = find_pr(github)
-    username = current_user()
+    if templates is not None:
+        # Stacks that weren't planned keep the result from the previous run, if it is still current
+        planned = {stack.key for stack in stacks}
+        previous = current_sections(comments, [stack for stack in defined if stack.key not in planned])
+        sections = {
+            stack.key: sections.get(stack.key) if stack.key in planned else previous.get(stack.key)
+            for stack in defined
+        }
 
-    comment = find_comment(github, issue_url, username, {})
+    with metrics.span('render'):
+        bodies = render_comments([section for section in sections.values() if section is not None], unchanged)
+    print('<hr>\n'.join(bodies))
 
-    update_comment(github, comment, body=result)
+    with metrics.span('github.update_comments'):
+        update_comments(comments, bodies)
 
     if any(is_failed(changeset) for _, changeset in changesets):
         raise Exception("One or more changesets failed")
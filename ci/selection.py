@@ -0,0 +1,85 @@
+import os
+import subprocess
+import logging
+from pathlib import Path
+from typing import Optional
+
+from api import GithubApi, PrUrl
+
+logger = logging.getLogger(__name__)
+debug = logger.debug
+
+# Set to plan every stack, whatever the PR changes
+plan_all_stacks = os.environ.get('PLAN_ALL_STACKS', 'false').lower() == 'true'
+
+def changed_files_from_github(github: GithubApi, pr_url: PrUrl) -> Optional[list[str]]:
+    """The files changed by a PR, or None if they can't be listed"""
+
+    try:
+        files = []
+        for file in github.paged_get(pr_url + '/files', params={'per_page': 100}):
+            files.append(file['filename'])
+            if 'previous_filename' in file:
+                files.append(file['previous_filename'])
+        return files
+    except Exception as e:
+        debug(f'Unable to list the files changed by {pr_url}: {e}')
+        return None
+
+def changed_files_from_git(base_ref: str) -> Optional[list[str]]:
+    """The files changed since the branch diverged from base_ref, or None if git can't tell"""
+
+    try:
+        result = subprocess.run(
+            ['git', 'diff', '--name-only', f'{base_ref}...HEAD'],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return result.stdout.splitlines()
+    except (OSError, subprocess.CalledProcessError) as e:
+        debug(f'Unable to diff against {base_ref}: {e}')
+        return None
+
+def changed_files(github: GithubApi, pr_url: PrUrl) -> Optional[list[str]]:
+    """
+    The files changed by a PR
+
+    Asks GitHub first, then falls back to diffing against the base ref of the webhook event.
+    """
+
+    if (files := changed_files_from_github(github, pr_url)) is not None:
+        return files
+
+    if base_ref := os.environ.get('CODEBUILD_WEBHOOK_BASE_REF'):
+        return changed_files_from_git(f"origin/{base_ref.removeprefix('refs/heads/')}")
+
+    return None
+
+def planned_templates(github: GithubApi, pr_url: PrUrl, stacks_path: Path) -> Optional[list[Path]]:
+    """
+    The templates that need to be planned for a PR
+
+    Returns None if every stack should be planned, which is when:
+    - PLAN_ALL_STACKS is set
+    - the changed files can't be found
+    - stacks.yaml itself is changed
+    """
+
+    if plan_all_stacks:
+        debug('Planning every stack because PLAN_ALL_STACKS is set')
+        return None
+
+    files = changed_files(github, pr_url)
+
+    if files is None:
+        debug("Planning every stack because the PR's changed files are unknown")
+        return None
+
+    paths = [Path(file) for file in files]
+
+    if stacks_path in paths:
+        debug(f'Planning every stack because {stacks_path} has changed')
+        return None
+
+    return paths
@@ -0,0 +1,256 @@
+"""
+A long-running service that handles webhook events without starting a new process for each one
+
+Events are posted as json to /events:
+
+    {"action": "plan" | "apply", "environment": {"CODEBUILD_WEBHOOK_EVENT": ..., ...}}
+
+Each request must be signed with the secret in SERVICE_SECRET, the same way GitHub signs webhooks:
+an `X-Signature-256: sha256=<hex digest>` header with the HMAC-SHA256 of the body.
+
+The environment is the CODEBUILD_* variables CodeBuild would have set for the build, and is applied while the event is handled.
+No other variables are accepted. The commit in CODEBUILD_RESOLVED_SOURCE_VERSION is checked out into a temporary worktree
+of the repository the service was started in, and the event is handled there.
+Every other setting (e.g. GITHUB_TOKEN, TEMPLATE_BUCKET, CHANGESET_CONCURRENCY) comes from the service's own environment,
+and most are only read when the modules are first imported.
+
+Events are handled one at a time, by the same pr.main and main.main a build would run.
+The GitHub session, assumed role credentials and caches stay warm between events.
+
+A pending event is replaced by a later event for the same PR (or a later push to apply), so a burst
+of pushes only results in one run for the latest commit.
+
+To run against local stub endpoints, set GITHUB_API_URL for GitHub,
+and AWS_ENDPOINT_URL (or AWS_ENDPOINT_URL_STS and AWS_ENDPOINT_URL_CLOUDFORMATION) for AWS.
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import re
+import subprocess
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Any, Iterator, NamedTuple
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+debug = logger.debug
+
+_commit_re = re.compile(r'^[0-9a-f]{40}$')
+
+def signature(body: bytes, secret: str) -> str:
+    """The X-Signature-256 header for a request body"""
+    return 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+class Event(NamedTuple):
+    action: str
+    environment: dict[str, str]
+
+    @property
+    def key(self) -> str:
+        """Events with the same key supersede each other"""
+
+        repo = self.environment.get('CODEBUILD_SOURCE_REPO_URL', '')
+
+        if self.action == 'plan':
+            return f'plan {repo} {self.environment.get("CODEBUILD_WEBHOOK_TRIGGER", self.environment.get("CODEBUILD_RESOLVED_SOURCE_VERSION", ""))}'
+
+        return f'apply {repo}'
+
+class EventQueue:
+    """
+    A queue of events waiting to be handled
+
+    Adding an event with the same key as a pending event replaces it, keeping its place in the queue.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending: OrderedDict[str, Event] = OrderedDict()
+
+        self.received = 0
+        self.coalesced = 0
+
+    def put(self, event: Event) -> None:
+        with self._condition:
+            self.received += 1
+
+            if event.key in self._pending:
+                debug(f'Replacing pending event {event.key}')
+                self.coalesced += 1
+
+            self._pending[event.key] = event
+            self._condition.notify()
+
+    def get(self) -> Event:
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+
+            _, event = self._pending.popitem(last=False)
+            return event
+
+    def __len__(self) -> int:
+        with self._condition:
+            return len(self._pending)
+
+@contextmanager
+def environment(env: dict[str, str]) -> Iterator[None]:
+    """Set environment variables while handling an event"""
+
+    previous = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+def git(*args: str) -> str:
+    return subprocess.run(['git', *args], check=True, stdout=subprocess.PIPE, text=True).stdout.strip()
+
+@contextmanager
+def checkout(commit: str) -> Iterator[None]:
+    """Check out a commit into a temporary worktree, and work in it while handling an event"""
+
+    try:
+        git('cat-file', '-e', f'{commit}^{{commit}}')
+    except subprocess.CalledProcessError:
+        debug(f'Fetching {commit}')
+        git('fetch', '--quiet', 'origin', commit)
+
+    previous = os.getcwd()
+
+    with tempfile.TemporaryDirectory(prefix='aws-users-') as temp_dir:
+        worktree = os.path.join(temp_dir, 'worktree')
+        git('worktree', 'add', '--quiet', '--detach', worktree, commit)
+
+        try:
+            os.chdir(worktree)
+            yield
+        finally:
+            os.chdir(previous)
+            git('worktree', 'remove', '--force', worktree)
+
+def handle(event: Event) -> None:
+    # Imported here so the service can start listening before the heavier modules are loaded
+    import main
+    import metrics
+    import pr
+
+    metrics.reset()
+
+    with checkout(event.environment['CODEBUILD_RESOLVED_SOURCE_VERSION']), environment(event.environment):
+        if event.action == 'plan':
+            pr.main()
+        else:
+            main.main()
+
+class Worker(threading.Thread):
+    """Handles events from the queue one at a time"""
+
+    def __init__(self, queue: EventQueue):
+        super().__init__(name='event-worker', daemon=True)
+        self._queue = queue
+
+        self.handled = 0
+        self.failed = 0
+        self.busy = False
+
+    def run(self) -> None:
+        while True:
+            event = self._queue.get()
+            logger.info(f'Handling event {event.key}')
+
+            self.busy = True
+            try:
+                handle(event)
+            except Exception:
+                logger.exception(f'Failed to handle event {event.key}')
+                self.failed += 1
+            finally:
+                self.busy = False
+                self.handled += 1
+
+def request_handler(queue: EventQueue, worker: Worker, secret: str) -> type[BaseHTTPRequestHandler]:
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _respond(self, status: int, body: dict[str, Any]) -> None:
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('content-type', 'application/json')
+            self.send_header('content-length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self) -> None:
+            if self.path != '/health':
+                return self._respond(404, {'message': 'Not Found'})
+
+            self._respond(200, {
+                'pending': len(queue),
+                'received': queue.received,
+                'coalesced': queue.coalesced,
+                'handled': worker.handled,
+                'failed': worker.failed,
+                'busy': worker.busy,
+            })
+
+        def do_POST(self) -> None:
+            if self.path != '/events':
+                return self._respond(404, {'message': 'Not Found'})
+
+            body = self.rfile.read(int(self.headers.get('content-length', 0)))
+
+            if not hmac.compare_digest(self.headers.get('x-signature-256', '').encode(), signature(body, secret).encode()):
+                return self._respond(401, {'message': 'Invalid signature'})
+
+            try:
+                payload = json.loads(body)
+                event = Event(payload['action'], {str(k): str(v) for k, v in payload.get('environment', {}).items()})
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                return self._respond(400, {'message': f'Invalid event: {e}'})
+
+            if event.action not in ['plan', 'apply']:
+                return self._respond(400, {'message': f'Unknown action {event.action}'})
+
+            if disallowed := sorted(name for name in event.environment if not name.startswith('CODEBUILD_')):
+                return self._respond(400, {'message': f'Only CODEBUILD_ variables can be set, not {", ".join(disallowed)}'})
+
+            if not _commit_re.match(event.environment.get('CODEBUILD_RESOLVED_SOURCE_VERSION', '')):
+                return self._respond(400, {'message': 'CODEBUILD_RESOLVED_SOURCE_VERSION must be a commit sha'})
+
+            queue.put(event)
+            self._respond(202, {'key': event.key})
+
+        def log_message(self, format: str, *args: Any) -> None:
+            debug(format % args)
+
+    return Handler
+
+def serve(host: str, port: int, secret: str) -> None:
+    if not secret:
+        raise ValueError('SERVICE_SECRET must be set, events are only accepted if they are signed with it')
+
+    queue = EventQueue()
+    worker = Worker(queue)
+    worker.start()
+
+    server = ThreadingHTTPServer((host, port), request_handler(queue, worker, secret))
+    logger.info(f'Listening on {host}:{server.server_port}')
+    server.serve_forever()
+
+if __name__ == '__main__':
+    serve(os.environ.get('SERVICE_HOST', '127.0.0.1'), int(os.environ.get('SERVICE_PORT', 8080)), os.environ.get('SERVICE_SECRET', ''))
@@ -0,0 +1,175 @@
+import threading
+import time
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from changesets import Stack, cloudformation, changeset_wait_timeout
+
+logger = logging.getLogger()
+debug = logger.debug
+
+# Stack statuses that end an operation
+succeeded_statuses = ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'IMPORT_COMPLETE']
+failed_statuses = [
+    'CREATE_FAILED', 'ROLLBACK_COMPLETE', 'ROLLBACK_FAILED',
+    'UPDATE_FAILED', 'UPDATE_ROLLBACK_COMPLETE', 'UPDATE_ROLLBACK_FAILED',
+    'IMPORT_ROLLBACK_COMPLETE', 'IMPORT_ROLLBACK_FAILED',
+]
+
+# How often a stack's events are polled, in seconds. The delay grows while there are no new events.
+min_poll_delay = 2
+max_poll_delay = 15
+
+@dataclass(eq=False)
+class StackOperation:
+    """An operation on a stack that is being watched"""
+
+    stack: Stack
+    stack_id: str
+    last_event_id: Optional[str]
+
+    status: Optional[str] = None
+    reason: str = ''
+
+    next_poll: float = 0
+    delay: float = min_poll_delay
+    done: threading.Event = field(default_factory=threading.Event)
+
+    @property
+    def succeeded(self) -> bool:
+        return self.status in succeeded_statuses
+
+    def wait(self, timeout: float = changeset_wait_timeout) -> None:
+        """Wait for the operation to finish"""
+
+        if not self.done.wait(timeout):
+            raise TimeoutError(f'Timed out waiting for {self.stack.key} to finish updating')
+
+class StackWatcher:
+    """
+    Watches operations on stacks by tailing their stack events
+
+    Every watched stack is polled from the same loop, on a thread started by using the watcher as a context manager.
+    Each poll only fetches the events since the last one seen, and each new event is logged as progress.
+    The operation is finished when the stack itself reaches a terminal status.
+
+    >>> with StackWatcher() as watcher:
+    ...     operation = watcher.watch(stack, stack_id)
+    ...     execute_changeset(stack, changeset)
+    ...     operation.wait()
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._operations: list[StackOperation] = []
+        self._thread = threading.Thread(target=self._run, name='stack-events', daemon=True)
+
+    def __enter__(self) -> 'StackWatcher':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stopped = True
+        self._wake.set()
+        self._thread.join()
+
+    def watch(self, stack: Stack, stack_id: str) -> StackOperation:
+        """
+        Start watching a stack
+
+        This should be called before the operation is started, so that none of its events are missed.
+        """
+
+        response = cloudformation().changeset_executor(stack.account_id).describe_stack_events(StackName=stack_id)
+        events = response.get('StackEvents', [])
+
+        operation = StackOperation(stack, stack_id, events[0]['EventId'] if events else None)
+        operation.next_poll = time.monotonic() + min_poll_delay
+
+        with self._lock:
+            self._operations.append(operation)
+
+        self._wake.set()
+        return operation
+
+    def unwatch(self, operation: StackOperation) -> None:
+        """Stop watching a stack, e.g. because the operation couldn't be started"""
+
+        with self._lock:
+            if operation in self._operations:
+                self._operations.remove(operation)
+
+    def _new_events(self, operation: StackOperation) -> list[dict[str, Any]]:
+        """Get the events since the last one seen, oldest first"""
+
+        client = cloudformation().changeset_executor(operation.stack.account_id)
+
+        events = []
+        kwargs = {}
+
+        # Events are listed newest first, so only the pages up to the last seen event are fetched
+        while True:
+            response = client.describe_stack_events(StackName=operation.stack_id, **kwargs)
+
+            for event in response.get('StackEvents', []):
+                if event['EventId'] == operation.last_event_id:
+                    return list(reversed(events))
+                events.append(event)
+
+            if 'NextToken' not in response:
+                return list(reversed(events))
+            kwargs['NextToken'] = response['NextToken']
+
+    def _poll(self, operation: StackOperation) -> None:
+        events = self._new_events(operation)
+
+        for event in events:
+            reason = f": {event['ResourceStatusReason']}" if event.get('ResourceStatusReason') else ''
+            logger.info(f"{operation.stack.key}: {event['ResourceStatus']} {event['ResourceType']} {event['LogicalResourceId']}{reason}")
+
+            operation.last_event_id = event['EventId']
+
+            if event['PhysicalResourceId'] != operation.stack_id or event['ResourceType'] != 'AWS::CloudFormation::Stack':
+                continue
+
+            if event['ResourceStatus'].endswith('ROLLBACK_IN_PROGRESS') or event['ResourceStatus'] in failed_statuses:
+                # The reason for a rollback is on the event that started it
+                operation.reason = operation.reason or event.get('ResourceStatusReason', '')
+
+            if event['ResourceStatus'] in succeeded_statuses + failed_statuses:
+                operation.status = event['ResourceStatus']
+
+        # Poll again soon while there is activity, backing off while there isn't
+        operation.delay = min_poll_delay if events else min(operation.delay * 2, max_poll_delay)
+
+    def _run(self) -> None:
+        while not self._stopped:
+            now = time.monotonic()
+
+            with self._lock:
+                due = [operation for operation in self._operations if operation.next_poll <= now]
+
+            for operation in due:
+                try:
+                    self._poll(operation)
+                except Exception:
+                    logger.exception(f'Failed to get the events for {operation.stack.key}')
+                    operation.delay = min(operation.delay * 2, max_poll_delay)
+
+                operation.next_poll = time.monotonic() + operation.delay
+
+                if operation.status is not None:
+                    debug(f'{operation.stack.key} finished with {operation.status}')
+                    self.unwatch(operation)
+                    operation.done.set()
+
+            # Cleared before deciding how long to wait, so a stack watched from now on wakes the loop
+            self._wake.clear()
+
+            with self._lock:
+                next_poll = min((operation.next_poll for operation in self._operations), default=now + max_poll_delay)
+
+            self._wake.wait(max(next_poll - time.monotonic(), 0))
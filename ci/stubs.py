@@ -0,0 +1,582 @@
+"""
+Local stand-ins for the GitHub and AWS APIs
+
+GitHubStub serves the parts of the GitHub REST and GraphQL APIs that pr.py and main.py use.
+AwsStub serves the parts of the STS and CloudFormation query APIs they use, for boto3 clients
+pointed at it with AWS_ENDPOINT_URL.
+
+Both run in a background thread on a free local port, count the requests they receive,
+and can add latency and enforce rate limits, so the CodeBuild entry points can be run against them at any scale.
+"""
+
+import datetime
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+import logging
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Any, Optional
+from urllib.parse import urlsplit, parse_qs, urlencode
+from xml.sax.saxutils import escape
+
+logger = logging.getLogger(__name__)
+debug = logger.debug
+
+class _Server(ThreadingHTTPServer):
+    """An http server on a free local port, serving from a daemon thread"""
+
+    daemon_threads = True
+
+    def __init__(self, latency: float):
+        super().__init__(('127.0.0.1', 0), self._handler())
+        self.latency = latency
+
+        self._lock = threading.Lock()
+        self.calls: Counter[str] = Counter()
+        self._thread = threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def count(self, call: str) -> None:
+        with self._lock:
+            self.calls[call] += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        raise NotImplementedError
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Otherwise the body waits for the headers to be acknowledged, adding 40ms to every keep-alive response
+    disable_nagle_algorithm = True
+    server: _Server
+
+    def respond(self, status: int, content: bytes, content_type: str, headers: Optional[dict[str, str]] = None) -> None:
+        time.sleep(self.server.latency)
+
+        self.send_response(status)
+        self.send_header('content-type', content_type)
+        self.send_header('content-length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('content-length', 0)))
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+class GitHubStub(_Server):
+    """
+    A GitHub API for a single repo with one open PR
+
+    The PR changes `files`, and already has `comments` comments from another user.
+    Paged resources return at most `page_size` items per page, with next and last links.
+    Every request uses up the rate limit, which resets every `rate_limit_window` seconds.
+    """
+
+    def __init__(
+        self,
+        *,
+        repo: str = 'hmrc/aws-users',
+        login: str = 'aws-users-bot',
+        files: Optional[list[str]] = None,
+        comments: int = 0,
+        merge_commit: str = 'merge-commit',
+        page_size: int = 100,
+        rate_limit: int = 5000,
+        rate_limit_window: float = 60 * 60,
+        latency: float = 0,
+    ):
+        super().__init__(latency)
+
+        self.repo = repo
+        self.login = login
+        self.files = files or []
+        self.merge_commit = merge_commit
+        self.page_size = page_size
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+
+        self._remaining = rate_limit
+        self._reset = time.time() + rate_limit_window
+        self.rate_limited = 0
+
+        self._next_id = 1
+        self.comments: list[dict[str, Any]] = []
+        for number in range(comments):
+            self.add_comment('someone-else', f'Comment {number}\n\n' + 'Looks good to me. ' * 20)
+
+    @property
+    def pr_url(self) -> str:
+        return f'{self.url}/repos/{self.repo}/pulls/1'
+
+    @property
+    def issue_url(self) -> str:
+        return f'{self.url}/repos/{self.repo}/issues/1'
+
+    def add_comment(self, login: str, body: str) -> dict[str, Any]:
+        with self._lock:
+            comment_id = self._next_id
+            self._next_id += 1
+
+        comment = {
+            'id': comment_id,
+            'url': f'{self.url}/repos/{self.repo}/issues/comments/{comment_id}',
+            'issue_url': self.issue_url,
+            'user': {'login': login},
+            'body': body,
+        }
+        self.comments.append(comment)
+        return comment
+
+    def use_rate_limit(self) -> tuple[bool, dict[str, str]]:
+        """
+        Use a request from the rate limit
+
+        :returns: If the request is allowed, and the rate limit headers for the response
+        """
+
+        with self._lock:
+            now = time.time()
+            if now >= self._reset:
+                self._remaining = self.rate_limit
+                self._reset = now + self.rate_limit_window
+
+            allowed = self._remaining > 0
+            if allowed:
+                self._remaining -= 1
+            else:
+                self.rate_limited += 1
+
+            return allowed, {
+                'X-RateLimit-Limit': str(self.rate_limit),
+                'X-RateLimit-Remaining': str(self._remaining),
+                'X-RateLimit-Reset': str(int(self._reset)),
+            }
+
+    def pull_request(self) -> dict[str, Any]:
+        return {
+            'url': self.pr_url,
+            'number': 1,
+            'merged_at': '2020-01-01T00:00:00Z',
+            'merge_commit_sha': self.merge_commit,
+            '_links': {'issue': {'href': self.issue_url}},
+        }
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        return _GitHubHandler
+
+# Ids in paths, so requests are counted by endpoint
+_id_re = re.compile(r'/(?:[0-9a-f]{40}|\d+)(?=/|$)')
+
+class _GitHubHandler(_Handler):
+    server: GitHubStub
+
+    def json(self, status: int, value: Any, headers: Optional[dict[str, str]] = None) -> None:
+        self.respond(status, json.dumps(value).encode(), 'application/json', headers)
+
+    def handle_request(self, method: str) -> None:
+        url = urlsplit(self.path)
+        path = url.path
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        body = self.read_body()
+        stub = self.server
+
+        stub.count(f'{method} {_id_re.sub("/{id}", path)}')
+        allowed, rate_limit = stub.use_rate_limit()
+
+        if not allowed:
+            return self.json(403, {'message': 'API rate limit exceeded'}, rate_limit)
+
+        repo = f'/repos/{stub.repo}'
+
+        if method == 'GET' and path == '/user':
+            return self.json(200, {'login': stub.login}, rate_limit)
+
+        if method == 'POST' and path == '/graphql':
+            return self.json(200, self.graphql(json.loads(body)), rate_limit)
+
+        if method == 'GET' and path == f'{repo}/pulls/1/files':
+            return self.paged([{'filename': file} for file in stub.files], query, rate_limit)
+
+        if method == 'GET' and path == f'{repo}/pulls':
+            return self.paged([stub.pull_request()], query, rate_limit)
+
+        if method == 'GET' and re.fullmatch(f'{repo}/commits/[^/]+/pulls', path):
+            return self.json(200, [stub.pull_request()] if path.split('/')[-2] == stub.merge_commit else [], rate_limit)
+
+        if method == 'GET' and path == f'{repo}/issues/1/comments':
+            return self.paged(stub.comments, query, rate_limit)
+
+        if method == 'POST' and path == f'{repo}/issues/1/comments':
+            comment = stub.add_comment(stub.login, json.loads(body)['body'])
+            return self.json(201, comment, rate_limit)
+
+        if method == 'PATCH' and (match := re.fullmatch(f'{repo}/issues/comments/(\\d+)', path)):
+            for comment in stub.comments:
+                if comment['id'] == int(match[1]):
+                    comment['body'] = json.loads(body)['body']
+                    return self.json(200, comment, rate_limit)
+
+        self.json(404, {'message': 'Not Found'}, rate_limit)
+
+    def paged(self, items: list[dict[str, Any]], query: dict[str, str], headers: dict[str, str]) -> None:
+        per_page = min(int(query.get('per_page', 30)), self.server.page_size)
+        page = int(query.get('page', 1))
+        last_page = max((len(items) + per_page - 1) // per_page, 1)
+
+        content = json.dumps(items[(page - 1) * per_page:page * per_page]).encode()
+        etag = f'"{hashlib.sha256(content).hexdigest()}"'
+
+        def page_url(number: int) -> str:
+            return f'{self.server.url}{urlsplit(self.path).path}?{urlencode({**query, "page": number})}'
+
+        links = []
+        if page < last_page:
+            links.append(f'<{page_url(page + 1)}>; rel="next"')
+            links.append(f'<{page_url(last_page)}>; rel="last"')
+
+        headers = {**headers, 'ETag': etag}
+        if links:
+            headers['Link'] = ', '.join(links)
+
+        if self.headers.get('If-None-Match') == etag:
+            return self.respond(304, b'', 'application/json', headers)
+
+        self.respond(200, content, 'application/json', headers)
+
+    def graphql(self, request: dict[str, Any]) -> dict[str, Any]:
+        if 'viewer' in request['query']:
+            return {'data': {'viewer': {'login': self.server.login}}}
+
+        # Comments, newest last, paged backwards from `before`
+        comments = self.server.comments
+        end = int(request['variables'].get('before') or len(comments))
+        start = max(end - 50, 0)
+
+        return {'data': {'repository': {'issueOrPullRequest': {'comments': {
+            'pageInfo': {'hasPreviousPage': start > 0, 'startCursor': str(start)},
+            'nodes': [
+                {'databaseId': comment['id'], 'author': comment['user'], 'body': comment['body']}
+                for comment in comments[start:end]
+            ],
+        }}}}}
+
+    def do_GET(self) -> None:
+        self.handle_request('GET')
+
+    def do_POST(self) -> None:
+        self.handle_request('POST')
+
+    def do_PATCH(self) -> None:
+        self.handle_request('PATCH')
+
+def _xml(value: Any) -> str:
+    """Serialize a value the way the AWS query protocol does, with list items as <member> elements"""
+
+    if isinstance(value, dict):
+        return ''.join(f'<{name}>{_xml(item)}</{name}>' for name, item in value.items() if item is not None)
+    if isinstance(value, list):
+        return ''.join(f'<member>{_xml(item)}</member>' for item in value)
+    return escape(str(value))
+
+class AwsStub(_Server):
+    """
+    The STS and CloudFormation APIs for any number of accounts, and S3 objects for staged templates
+
+    Every stack in `stacks` already exists, deployed with a different template. A changeset has `changes` changes,
+    and is created `changeset_delay` seconds after it is requested. Executing a changeset completes immediately,
+    adding the stack events for the update.
+
+    The credentials returned by AssumeRole identify the account, so later requests are made against that account.
+    At most `request_rate` requests per second are allowed before requests are throttled, 0 for no limit.
+    """
+
+    def __init__(
+        self,
+        *,
+        stacks: list[tuple[str, str]],
+        changes: int = 10,
+        changes_page_size: int = 100,
+        changeset_delay: float = 0,
+        request_rate: float = 0,
+        latency: float = 0,
+    ):
+        super().__init__(latency)
+
+        self.changes = changes
+        self.changes_page_size = changes_page_size
+        self.changeset_delay = changeset_delay
+        self.request_rate = request_rate
+        self.throttled = 0
+
+        self._window_start = time.monotonic()
+        self._window_requests = 0
+
+        self.stacks: dict[tuple[str, str], dict[str, Any]] = {
+            (account_id, stack_name): {
+                'StackId': f'arn:aws:cloudformation:eu-west-1:{account_id}:stack/{stack_name}/{uuid.uuid4()}',
+                'StackName': stack_name,
+                'StackStatus': 'UPDATE_COMPLETE',
+                'TemplateBody': '{"Resources": {}}',
+                'Parameters': {},
+                'Events': [],
+            }
+            for account_id, stack_name in stacks
+        }
+
+        for stack in self.stacks.values():
+            self.add_event(stack, stack['StackName'], 'AWS::CloudFormation::Stack', 'UPDATE_COMPLETE')
+
+        self.changesets: dict[str, dict[str, Any]] = {}
+
+        # S3 objects by key, in any bucket
+        self.objects: dict[str, bytes] = {}
+
+    def add_event(self, stack: dict[str, Any], logical_id: str, resource_type: str, status: str) -> None:
+        """Add an event to a stack, events are kept newest first"""
+
+        stack['Events'].insert(0, {
+            'StackId': stack['StackId'],
+            'EventId': str(uuid.uuid4()),
+            'StackName': stack['StackName'],
+            'LogicalResourceId': logical_id,
+            'PhysicalResourceId': stack['StackId'] if resource_type == 'AWS::CloudFormation::Stack' else logical_id,
+            'ResourceType': resource_type,
+            'Timestamp': datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'ResourceStatus': status,
+        })
+
+    def throttle(self) -> bool:
+        """Should this request be throttled"""
+
+        if not self.request_rate:
+            return False
+
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= 1:
+                self._window_start = now
+                self._window_requests = 0
+
+            self._window_requests += 1
+            if self._window_requests > self.request_rate:
+                self.throttled += 1
+                return True
+
+            return False
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        return _AwsHandler
+
+class _AwsHandler(_Handler):
+    server: AwsStub
+
+    def object_key(self) -> str:
+        # Requests to a local endpoint use path style addressing, /<bucket>/<key>
+        return urlsplit(self.path).path.split('/', 2)[2]
+
+    def do_HEAD(self) -> None:
+        self.server.count('HeadObject')
+
+        if (content := self.server.objects.get(self.object_key())) is None:
+            return self.respond(404, b'', 'application/xml')
+
+        self.send_response(200)
+        self.send_header('content-length', str(len(content)))
+        self.end_headers()
+
+    def do_PUT(self) -> None:
+        self.server.count('PutObject')
+
+        self.server.objects[self.object_key()] = self.read_body()
+        self.respond(200, b'', 'application/xml', {'ETag': f'"{uuid.uuid4().hex}"'})
+
+    def do_POST(self) -> None:
+        params = {name: values[0] for name, values in parse_qs(self.read_body().decode()).items()}
+        action = params.get('Action', '')
+        stub = self.server
+
+        stub.count(action)
+
+        if stub.throttle():
+            return self.error(400, 'Throttling', 'Rate exceeded')
+
+        # The access key of an assumed role is the account id
+        account_id = re.search(r'Credential=(\w+)/', self.headers.get('authorization', ''))[1][-12:]
+
+        try:
+            result = getattr(self, action)(account_id, params)
+        except KeyError as e:
+            return self.error(400, 'ValidationError', f'{e.args[0]} does not exist')
+
+        namespace = 'https://sts.amazonaws.com/doc/2011-06-15/' if action == 'AssumeRole' else 'http://cloudformation.amazonaws.com/doc/2010-05-15/'
+        content = f'<{action}Response xmlns="{namespace}"><{action}Result>{_xml(result)}</{action}Result><ResponseMetadata><RequestId>{uuid.uuid4()}</RequestId></ResponseMetadata></{action}Response>'
+        self.respond(200, content.encode(), 'text/xml')
+
+    def error(self, status: int, code: str, message: str) -> None:
+        content = f'<ErrorResponse><Error><Type>Sender</Type><Code>{code}</Code><Message>{escape(message)}</Message></Error><RequestId>{uuid.uuid4()}</RequestId></ErrorResponse>'
+        self.respond(status, content.encode(), 'text/xml')
+
+    def stack(self, account_id: str, name: str) -> dict[str, Any]:
+        if name.startswith('arn:'):
+            account_id, name = name.split(':')[4], name.split('/')[1]
+
+        try:
+            return self.server.stacks[account_id, name]
+        except KeyError:
+            raise KeyError(f'Stack with id {name}')
+
+    def changeset(self, changeset_id: str) -> dict[str, Any]:
+        changeset = self.server.changesets[changeset_id]
+
+        if changeset['Status'] == 'CREATE_IN_PROGRESS' and time.monotonic() >= changeset['created']:
+            changeset['Status'] = 'CREATE_COMPLETE'
+            changeset['ExecutionStatus'] = 'AVAILABLE'
+
+        return changeset
+
+    def AssumeRole(self, account_id: str, params: dict[str, str]) -> dict[str, Any]:
+        role_account_id = params['RoleArn'].split(':')[4]
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=int(params.get('DurationSeconds', 3600)))
+
+        return {
+            'Credentials': {
+                'AccessKeyId': f'ASIA{role_account_id}',
+                'SecretAccessKey': 'secret',
+                'SessionToken': 'token',
+                'Expiration': expiration.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            },
+            'AssumedRoleUser': {
+                'AssumedRoleId': f'AROA{role_account_id}:{params["RoleSessionName"]}',
+                'Arn': f'{params["RoleArn"]}/{params["RoleSessionName"]}',
+            },
+        }
+
+    def DescribeStacks(self, account_id: str, params: dict[str, str]) -> dict[str, Any]:
+        stack = self.stack(account_id, params['StackName'])
+
+        return {'Stacks': [{
+            'StackId': stack['StackId'],
+            'StackName': stack['StackName'],
+            'StackStatus': stack['StackStatus'],
+            'CreationTime': '2020-01-01T00:00:00Z',
+            'Parameters': [{'ParameterKey': key, 'ParameterValue': value} for key, value in stack['Parameters'].items()],
+        }]}
+
+    def GetTemplate(self, account_id: str, params: dict[str, str]) -> dict[str, Any]:
+        if 'ChangeSetName' in params:
+            return {'TemplateBody': self.changeset(params['ChangeSetName'])['TemplateBody']}
+
+        return {'TemplateBody': self.stack(account_id, params['StackName'])['TemplateBody']}
+
+    def CreateChangeSet(self, account_id: str, params: dict[str, str]) -> dict[str, Any]:
+        stack = self.stack(account_id, params['StackName'])
+        changeset_id = f'arn:aws:cloudformation:eu-west-1:{account_id}:changeSet/{params["ChangeSetName"]}/{uuid.uuid4()}'
+
+        parameters = {}
+        for name, value in params.items():
+            if match := re.fullmatch(r'Parameters\.member\.(\d+)\.ParameterKey', name):
+                parameters[value] = params[f'Parameters.member.{match[1]}.ParameterValue']
+
+        self.server.changesets[changeset_id] = {
+            'ChangeSetId': changeset_id,
+            'ChangeSetName': params['ChangeSetName'],
+            'StackId': stack['StackId'],
+            'StackName': stack['StackName'],
+            'Status': 'CREATE_IN_PROGRESS',
+            'ExecutionStatus': 'UNAVAILABLE',
+            'TemplateBody': params['TemplateBody'] if 'TemplateBody' in params else self.server.objects[urlsplit(params['TemplateURL']).path.lstrip('/')].decode(),
+            'Parameters': parameters,
+            'created': time.monotonic() + self.server.changeset_delay,
+        }
+
+        return {'Id': changeset_id, 'StackId': stack['StackId']}
+
+    def summary(self, changeset: dict[str, Any]) -> dict[str, Any]:
+        return {
+            'ChangeSetId': changeset['ChangeSetId'],
+            'ChangeSetName': changeset['ChangeSetName'],
+            'StackId': changeset['StackId'],
+            'StackName': changeset['StackName'],
+            'Status': changeset['Status'],
+            'ExecutionStatus': changeset['ExecutionStatus'],
+            'CreationTime': '2020-01-01T00:00:00Z',
+        }
+
+    def ListChangeSets(self, account_id: str, params: dict[str, str]) -> dict[str, Any]:
+        stack = self.stack(account_id, params['StackName'])
+
+        return {'Summaries': [
+            self.summary(self.changeset(changeset_id))
+            for changeset_id, changeset in list(self.server.changesets.items())
+            if changeset['StackId'] == stack['StackId']
+        ]}
+
+    def DescribeChangeSet(self, account_id: str, params: dict[str, str]) -> dict[str, Any]:
+        changeset = self.changeset(params['ChangeSetName'])
+
+        start = int(params.get('NextToken', 0))
+        end = min(start + self.server.changes_page_size, self.server.changes)
+
+        return {
+            **self.summary(changeset),
+            'Parameters': [{'ParameterKey': key, 'ParameterValue': value} for key, value in changeset['Parameters'].items()],
+            'Changes': [
+                {'Type': 'Resource', 'ResourceChange': {
+                    'Action': 'Modify',
+                    'LogicalResourceId': f'Resource{number}',
+                    'ResourceType': 'AWS::IAM::Role',
+                    'Replacement': 'False',
+                }}
+                for number in range(start, end)
+            ] if changeset['Status'] == 'CREATE_COMPLETE' else [],
+            'NextToken': str(end) if end < self.server.changes and changeset['Status'] == 'CREATE_COMPLETE' else None,
+        }
+
+    def ExecuteChangeSet(self, account_id: str, params: dict[str, str]) -> dict[str, Any]:
+        changeset = self.changeset(params['ChangeSetName'])
+        stack = self.stack(account_id, changeset['StackId'])
+
+        # Executing one changeset makes the others for the stack obsolete
+        for other in self.server.changesets.values():
+            if other['StackId'] == stack['StackId']:
+                other['ExecutionStatus'] = 'OBSOLETE'
+
+        changeset['ExecutionStatus'] = 'EXECUTE_COMPLETE'
+        stack['TemplateBody'] = changeset['TemplateBody']
+        stack['Parameters'] = changeset['Parameters']
+
+        self.server.add_event(stack, stack['StackName'], 'AWS::CloudFormation::Stack', 'UPDATE_IN_PROGRESS')
+        for number in range(self.server.changes):
+            self.server.add_event(stack, f'Resource{number}', 'AWS::IAM::Role', 'UPDATE_IN_PROGRESS')
+            self.server.add_event(stack, f'Resource{number}', 'AWS::IAM::Role', 'UPDATE_COMPLETE')
+        self.server.add_event(stack, stack['StackName'], 'AWS::CloudFormation::Stack', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS')
+        self.server.add_event(stack, stack['StackName'], 'AWS::CloudFormation::Stack', 'UPDATE_COMPLETE')
+
+        return {}
+
+    def DescribeStackEvents(self, account_id: str, params: dict[str, str]) -> dict[str, Any]:
+        events = self.stack(account_id, params['StackName'])['Events']
+
+        start = int(params.get('NextToken', 0))
+        end = start + 100
+
+        return {'StackEvents': events[start:end], 'NextToken': str(end) if end < len(events) else None}
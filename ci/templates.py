@@ -0,0 +1,169 @@
+import functools
+import hashlib
+import json
+import os
+import threading
+import logging
+from collections import defaultdict
+from typing import Any, Optional
+
+import metrics
+from config import Stack
+
+logger = logging.getLogger()
+debug = logger.debug
+
+# Templates are uploaded to this bucket and given to CloudFormation by url, instead of being sent inline.
+# Every account that stacks are deployed to must be able to read from it.
+template_bucket = os.environ.get('TEMPLATE_BUCKET')
+template_prefix = os.environ.get('TEMPLATE_BUCKET_PREFIX', 'templates/')
+template_bucket_region = os.environ.get('TEMPLATE_BUCKET_REGION', 'eu-west-1')
+
+# The intrinsic functions that have a short form YAML tag, e.g. `!Sub` for `Fn::Sub`
+_short_form_functions = [
+    'And', 'Base64', 'Cidr', 'Equals', 'FindInMap', 'GetAtt', 'GetAZs', 'If', 'ImportValue',
+    'Join', 'Length', 'Not', 'Or', 'Select', 'Split', 'Sub', 'ToJsonString', 'Transform',
+]
+
+@functools.cache
+def _yaml_loader() -> Any:
+    """A yaml loader that understands the CloudFormation short form tags"""
+
+    import yaml
+
+    class CloudFormationLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+        pass
+
+    def intrinsic_function(name: str):
+        def construct(loader, node) -> dict[str, Any]:
+            if isinstance(node, yaml.ScalarNode):
+                value = loader.construct_scalar(node)
+            elif isinstance(node, yaml.SequenceNode):
+                value = loader.construct_sequence(node, deep=True)
+            else:
+                value = loader.construct_mapping(node, deep=True)
+
+            if name in ['Ref', 'Condition']:
+                return {name: value}
+
+            if name == 'GetAtt' and isinstance(value, str):
+                # `!GetAtt Resource.Attribute` is short for `Fn::GetAtt: [Resource, Attribute]`
+                value = value.split('.', 1)
+
+            return {f'Fn::{name}': value}
+
+        return construct
+
+    for name in _short_form_functions + ['Ref', 'Condition']:
+        CloudFormationLoader.add_constructor(f'!{name}', intrinsic_function(name))
+
+    # Dates are kept as they are written, e.g. an unquoted IAM policy Version
+    CloudFormationLoader.add_constructor('tag:yaml.org,2002:timestamp', lambda loader, node: loader.construct_scalar(node))
+
+    return CloudFormationLoader
+
+def minify(template_body: str) -> str:
+    """
+    Convert a JSON or YAML template to compact JSON
+
+    Short form intrinsic functions are converted to their full form.
+    If the template can't be converted, it is returned as it is.
+    """
+
+    try:
+        return json.dumps(json.loads(template_body), separators=(',', ':'))
+    except ValueError:
+        pass
+
+    import yaml
+
+    try:
+        return json.dumps(yaml.load(template_body, Loader=_yaml_loader()), separators=(',', ':'))
+    except (yaml.YAMLError, TypeError, ValueError) as e:
+        debug(f'Unable to minify template: {e}')
+        return template_body
+
+class TemplateStore:
+    """
+    Templates staged in an S3 bucket
+
+    Each template is stored once, keyed by a hash of its content, so an unchanged template is never uploaded again.
+    This can be called from any thread.
+    """
+
+    def __init__(self, bucket: str, prefix: str, region: str):
+        self._bucket = bucket
+        self._prefix = prefix
+        self._region = region
+
+        self._lock = threading.Lock()
+        self._key_locks = defaultdict(threading.Lock)
+        self._stored: set[str] = set()
+        self._s3 = None
+
+    def _s3_client(self):
+        with self._lock:
+            if self._s3 is None:
+                import boto3
+                self._s3 = boto3.client('s3', region_name=self._region)
+                metrics.instrument_boto_client(self._s3)
+            return self._s3
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._key_locks[key]
+
+    def _exists(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            self._s3_client().head_object(Bucket=self._bucket, Key=key)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+                return False
+            raise
+
+    def url(self, template_body: str) -> str:
+        """Get the url of a template, uploading it if it isn't already in the bucket"""
+
+        key = f'{self._prefix}{hashlib.sha256(template_body.encode()).hexdigest()}.json'
+
+        with self._key_lock(key):
+            if key not in self._stored:
+                if self._exists(key):
+                    metrics.increment('templates.reused')
+                else:
+                    debug(f'Uploading template to s3://{self._bucket}/{key}')
+                    self._s3_client().put_object(Bucket=self._bucket, Key=key, Body=template_body.encode(), ContentType='application/json')
+                    metrics.increment('templates.uploaded')
+
+                with self._lock:
+                    self._stored.add(key)
+
+        return f'https://{self._bucket}.s3.{self._region}.amazonaws.com/{key}'
+
+@functools.cache
+def template_store() -> Optional[TemplateStore]:
+    """The template store for this process, if TEMPLATE_BUCKET is set"""
+
+    if not template_bucket:
+        return None
+
+    return TemplateStore(template_bucket, template_prefix, template_bucket_region)
+
+def submitted_template(stack: Stack) -> str:
+    """The template as it is given to CloudFormation, minified if it is staged in the bucket"""
+
+    if template_store() is None:
+        return stack.template()
+
+    return minify(stack.template())
+
+def template_parameter(template_body: str) -> dict[str, str]:
+    """The create_change_set parameter that gives CloudFormation the template"""
+
+    if (store := template_store()) is None:
+        return {'TemplateBody': template_body}
+
+    return {'TemplateURL': store.url(template_body)}
@@ -28,6 +28,8 @@ data "aws_iam_policy_document" "RoleChangeSetCreator" {
     actions = [
       "cloudformation:CreateChangeSet",
       "cloudformation:DescribeChangeSet",
+      "cloudformation:DescribeStacks",
+      "cloudformation:GetTemplate",
     ]
 
     resources = ["*"]
@@ -64,6 +66,8 @@ data "aws_iam_policy_document" "RoleIAMAdministrator" {
       "cloudformation:CreateChangeSet",
       "cloudformation:DescribeChangeSet",
       "cloudformation:ExecuteChangeSet",
+      "cloudformation:DescribeStackEvents",
+      "cloudformation:GetTemplate",
     ]
 
     resources = ["*"]